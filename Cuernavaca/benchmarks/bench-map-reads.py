@@ -0,0 +1,82 @@
+import os
+import imp
+import sys
+import time
+import random
+import argparse
+
+scripts = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts')
+sys.path.insert(0, scripts)
+map_reads = imp.load_source('map_reads', os.path.join(scripts, 'map-reads.py'))
+
+
+def mutate(seq, rate, rng):
+    """ Substitute a proportion of the bases of a sequence """
+    return ''.join(rng.choice('ACGT'.replace(base, '')) if rng.random() < rate else base
+                   for base in seq)
+
+
+def simulate_reads(refseq, nreads, length, rate, rng):
+    """
+    Sample reads from either strand of a reference, with substitutions.
+    :return: list of (zero-based position, is_reverse, sequence)
+    """
+    reads = []
+    for _ in range(nreads):
+        pos = rng.randint(0, len(refseq) - length)
+        seq = mutate(refseq[pos:(pos+length)], rate, rng)
+        is_reverse = rng.random() < 0.5
+        if is_reverse:
+            seq = map_reads.reverse_complement(seq)
+        reads.append((pos, is_reverse, seq))
+    return reads
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time map-reads.py on simulated reads, and check that reads are '
+                    'mapped where they were sampled, and that random and heavily '
+                    'mutated reads are not mapped.'
+    )
+    parser.add_argument('-ref', type=argparse.FileType('rU'),
+                        default=os.path.join(scripts, os.pardir, 'data', 'Zika-reference.fa'),
+                        help='<input> FASTA file containing reference')
+    parser.add_argument('-nreads', type=int, default=1000,
+                        help='Number of reads to simulate of each kind')
+    parser.add_argument('-length', type=int, default=150,
+                        help='Length of simulated reads')
+    args = parser.parse_args()
+
+    refs = [(h.split()[0], s.replace('-', '').upper())
+            for h, s in map_reads.convert_fasta(args.ref)]
+    kmer_index = map_reads.load_index(refs, 11)[0]
+    refseq = refs[0][1]
+    rng = random.Random(1)
+
+    # defaults of map-reads.py
+    options = dict(band=10, max_hits=50, min_seeds=2, max_mismatch=0.05, max_diff=0.3)
+    close = simulate_reads(refseq, args.nreads, args.length, 0.02, rng)
+    diverged = simulate_reads(refseq, args.nreads, args.length, 0.15, rng)
+    mutated = simulate_reads(refseq, args.nreads, args.length, 0.6, rng)
+    random_reads = [(None, False, ''.join(rng.choice('ACGT') for _ in range(args.length)))
+                    for _ in range(args.nreads)]
+
+    for label, reads, min_mapped, max_mapped in [('2% substitutions', close, 0.99, 1),
+                                                 ('15% substitutions', diverged, 0.9, 1),
+                                                 ('60% substitutions', mutated, 0, 0),
+                                                 ('random', random_reads, 0, 0)]:
+        start = time.time()
+        hits = [map_reads.map_read(kmer_index, seq, **options) for _, _, seq in reads]
+        elapsed = time.time() - start
+        nmapped = sum(hit is not None for hit in hits)
+        nplaced = sum(hit is not None and hit['is_reverse'] == is_reverse and
+                      abs(hit['pos'] - pos) <= options['band']
+                      for (pos, is_reverse, _), hit in zip(reads, hits))
+        print '%-18s %8.3f ms/read, %d of %d mapped, %d where they were sampled' % (
+            label, 1000 * elapsed / len(reads), nmapped, len(reads), nplaced)
+        assert min_mapped * len(reads) <= nplaced <= nmapped <= max_mapped * len(reads), \
+            'unexpected number of %s reads mapped' % label
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import os
+import imp
+import sys
+import time
+import random
+import argparse
+
+scripts = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts')
+sys.path.insert(0, scripts)
+slice_sam = imp.load_source('slice_sam', os.path.join(scripts, 'slice-sam.py'))
+
+
+def convert_fasta(handle):
+    """ Return the first sequence in a FASTA file as a string """
+    return ''.join(line.strip() for line in handle if not line.startswith('>'))
+
+
+def simulate_pairs(refseq, npairs, read_length=250, seed=1):
+    """
+    Sample read pairs from a reference sequence, padded on the left to
+    reference coordinates as parse_read_pair() does before merging.
+    Some bases are mutated and given low quality scores so that both the
+    concordant and discordant rules are exercised.
+    """
+    rng = random.Random(seed)
+    pairs = []
+    for _ in range(npairs):
+        insert_size = rng.randint(read_length // 2, 2 * read_length)
+        pos1 = rng.randint(0, len(refseq) - insert_size)
+        pos2 = max(0, pos1 + insert_size - read_length)  # mates may overlap
+        reads = []
+        for pos in (pos1, pos2):
+            seq = list(refseq[pos:(pos+read_length)])
+            qual = [chr(rng.randint(25, 40)+33) for _ in seq]
+            for i in rng.sample(range(len(seq)), 5):
+                seq[i] = rng.choice('ACGT')
+                qual[i] = chr(rng.randint(2, 14)+33)
+            reads.append(('-'*pos + ''.join(seq), '!'*pos + ''.join(qual)))
+        pairs.append(reads)
+    return pairs
+
+
+def bench(merge, pairs, qcut):
+    """ Return merged sequences and the rate of merging in pairs per second """
+    start = time.time()
+    mseqs = [merge(seq1, seq2, qual1, qual2, q_cutoff=qcut)
+             for (seq1, qual1), (seq2, qual2) in pairs]
+    return mseqs, len(pairs) / (time.time() - start)
+
+
+def bench_cutoffs(merge, pairs, qcuts):
+    """ Return {qcut: merged sequences} from merge_pairs_cutoffs() and the
+    rate of merging in pairs per second """
+    start = time.time()
+    results = [slice_sam.merge_pairs_cutoffs(seq1, seq2, qual1, qual2, qcuts, merge=merge)
+               for (seq1, qual1), (seq2, qual2) in pairs]
+    rate = len(pairs) / (time.time() - start)
+    return dict((qcut, [mseqs[qcut] for mseqs in results]) for qcut in qcuts), rate
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the speed of the merge_pairs engines in slice-sam.py '
+                    'on simulated read pairs.'
+    )
+    parser.add_argument('-ref', type=argparse.FileType('rU'),
+                        default=os.path.join(scripts, os.pardir, 'data', 'Zika-reference.fa'),
+                        help='<input> FASTA file containing reference')
+    parser.add_argument('-npairs', type=int, default=2000,
+                        help='Number of read pairs to simulate')
+    parser.add_argument('-qcut', type=int, default=15,
+                        help='Quality score cutoff for base censoring')
+    parser.add_argument('-qcuts', type=int, nargs='+', default=[10, 15, 20, 25, 30],
+                        help='Quality score cutoffs for merging each pair at several cutoffs')
+    args = parser.parse_args()
+
+    if slice_sam.np is None:
+        print 'ERROR: numpy engine requires the NumPy module.'
+        sys.exit()
+
+    pairs = simulate_pairs(convert_fasta(args.ref), args.npairs)
+    results = {}
+    for engine in ['python', 'numpy']:
+        mseqs, rate = bench(slice_sam.MERGE_ENGINES[engine], pairs, args.qcut)
+        results[engine] = mseqs
+        print '%-6s %10.1f reads/sec' % (engine, rate)
+
+    assert results['python'] == results['numpy'], 'Merge engines disagree!'
+    print 'Merged sequences are identical.'
+
+    # resolve each pair once, and censor it at each cutoff
+    expected = dict((qcut, bench(slice_sam.merge_pairs, pairs, qcut)[0]) for qcut in args.qcuts)
+    for engine in ['python', 'numpy']:
+        mseqs, rate = bench_cutoffs(slice_sam.MERGE_ENGINES[engine], pairs, args.qcuts)
+        print '%-6s %10.1f reads/sec at %d cutoffs' % (engine, rate, len(args.qcuts))
+        assert mseqs == expected, 'Merging at several cutoffs disagrees with merge_pairs()!'
+    print 'Merged sequences at every cutoff are identical.'
+
+
+if __name__ == '__main__':
+    main()
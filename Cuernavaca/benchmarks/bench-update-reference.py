@@ -0,0 +1,103 @@
+import os
+import imp
+import sys
+import time
+import random
+import argparse
+from distutils.spawn import find_executable
+
+scripts = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts')
+sys.path.insert(0, scripts)
+adapt_ref = imp.load_source('adapt_ref', os.path.join(scripts, 'adapt-ref.py'))
+
+NINDELS = 10
+
+
+def simulate_conseq(refseq, rng, coverage=0.9, nsubs=100, nindels=NINDELS, nruns=5):
+    """
+    Mutate a reference into a consensus sequence with substitutions, short
+    insertions and deletions and runs of ambiguous bases, and truncate it as
+    if reads did not cover the end of the reference.  Deletions are left as
+    gaps in the consensus, as pileup_to_conseq() does.
+    :return: (consensus, {'ref': aligned reference, 'conseq': aligned consensus})
+    """
+    aref = list(refseq)
+    aconseq = list(refseq)
+    for i in rng.sample(range(len(refseq)), nsubs):
+        aconseq[i] = rng.choice('ACGT'.replace(refseq[i], ''))
+    for _ in range(nruns):
+        i = rng.randint(0, len(refseq) - 50)
+        length = rng.randint(1, 50)
+        aconseq[i:(i+length)] = 'N' * length
+    # apply indels from the right so that earlier positions do not shift
+    sites = sorted(rng.sample(range(100, len(refseq) - 100), nindels), reverse=True)
+    for i in sites:
+        length = rng.choice([1, 2, 3, 6])
+        if rng.random() < 0.5:
+            aconseq[i:(i+length)] = '-' * length
+        else:
+            insert = [rng.choice('ACGT') for _ in range(length)]
+            aref[i:i] = '-' * length
+            aconseq[i:i] = insert
+
+    # reads do not cover the end of the reference
+    end = int(len(aref) * coverage)
+    aconseq[end:] = '-' * (len(aconseq) - end)
+    columns = [(r, c) for r, c in zip(aref, aconseq) if r != '-' or c != '-']
+    aref, aconseq = map(''.join, zip(*columns))
+    return aconseq.rstrip('-'), {'ref': aref, 'conseq': aconseq}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the banded aligner in adapt-ref.py against known '
+                    'alignments of simulated consensus sequences, and MAFFT if '
+                    'it is installed.'
+    )
+    parser.add_argument('-ref', type=argparse.FileType('rU'),
+                        default=os.path.join(scripts, os.pardir, 'data', 'Zika-reference.fa'),
+                        help='<input> FASTA file containing reference')
+    parser.add_argument('-nreps', type=int, default=20,
+                        help='Number of consensus sequences to simulate')
+    parser.add_argument('-band', type=int, default=100,
+                        help='Band width for the banded aligner')
+    args = parser.parse_args()
+
+    refseq = adapt_ref.convert_fasta(args.ref)[0][1].upper()
+    rng = random.Random(1)
+    cases = [simulate_conseq(refseq, rng) for _ in range(args.nreps)]
+
+    aligners = ['banded']
+    if find_executable('mafft'):
+        aligners.append('mafft')
+    for aligner in aligners:
+        start = time.time()
+        results = [adapt_ref.update_reference(refseq, conseq, band=args.band,
+                                              use_mafft=(aligner == 'mafft'))
+                   for conseq, _ in cases]
+        elapsed = time.time() - start
+        expected = [adapt_ref.merge_alignment(truth) for _, truth in cases]
+        nmatch = sum(newseq == exp_seq for (newseq, _), (exp_seq, _) in zip(results, expected))
+        ndiff_match = sum(ndiff == exp_ndiff
+                          for (_, ndiff), (_, exp_ndiff) in zip(results, expected))
+        # a substitution next to an indel can be scored as part of it, or an
+        # indel in a repeat placed at another copy of the repeat, which can
+        # move the count of differences by one for each simulated indel and
+        # occasionally changes the new reference without changing its score
+        max_error = max(abs(ndiff - exp_ndiff)
+                        for (_, ndiff), (_, exp_ndiff) in zip(results, expected))
+        print '%-6s %8.3f s/alignment, %d of %d updated references match known alignment ' \
+              '(%d with the same number of differences, off by at most %d)' % (
+                  aligner, elapsed / len(cases), nmatch, len(cases), ndiff_match, max_error)
+        if aligner == 'banded':
+            assert nmatch >= 0.95 * len(cases), \
+                'banded aligner did not reproduce enough known alignments'
+            assert max_error <= NINDELS, \
+                'banded aligner miscounted differences by more than one per indel'
+
+    # MAFFT alignments are merged as before, inserting ambiguous bases
+    assert adapt_ref.merge_alignment({'ref': 'AC-GT', 'conseq': 'ACNGT'}) == ('ACNGT', 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,17 @@ import sys
 import tempfile
 import os
 import argparse
+import hashlib
+import json
+import struct
+import itertools
+import multiprocessing
+import shutil
+
+import numpy as np
+
+from bamfile import open_alignments, is_bam
+import banded_align
 
 tempdir = tempfile.gettempdir()
 if not os.access(tempdir, os.W_OK):
@@ -10,7 +21,10 @@ if not os.access(tempdir, os.W_OK):
     tempdir = os.getcwd()
 
 cigar_re = re.compile('[0-9]+[MIDNSHPX=]')  # CIGAR token
-indel_re = re.compile('[+-][0-9]+')
+
+scratch = None  # scratch directory of a worker process, see init_worker()
+
+CACHE_VERSION = 2  # change when the format of cached pileups changes
 
 
 def is_first_read(flag):
@@ -21,206 +35,771 @@ def is_first_read(flag):
     IS_FIRST_SEGMENT = 0x40
     return (int(flag) & IS_FIRST_SEGMENT) != 0
 
+class Pileup(object):
+    """
+    Counts of base calls at each position of a reference, binned by quality
+    score so that a consensus can be generated for any quality cutoff in
+    Q_CUTOFFS.
+
+    Attributes:
+        counts: NumPy array of counts with one row per one-based reference
+            position, one column per allele in BASES and one layer per
+            range of quality scores from one cutoff in Q_CUTOFFS up to the
+            next, grows as needed.  Deletions are counted in layer 0.
+        insertions: {(pos, insert): {(base, q): count}} for insertions that
+            follow the base at pos, counted by the base call and quality
+            score at pos
+        offset: reference position of the first row of counts
+    """
+    def __init__(self, length=0):
+        self.counts = np.zeros((length+1, len(BASES), len(Q_CUTOFFS)), dtype=np.int32)
+        self.insertions = {}
+        self.offset = 0
+
+    def reserve(self, end):
+        """ Make sure that positions up to end can be counted """
+        if end - self.offset > self.counts.shape[0]:
+            size = max(end - self.offset, 2*self.counts.shape[0])
+            counts = np.zeros((size, len(BASES), len(Q_CUTOFFS)), dtype=np.int32)
+            counts[:self.counts.shape[0]] = self.counts
+            self.counts = counts
+
+    def calls(self, qCutoff):
+        """
+        Return an array of base call counts with one row per position and
+        one column per allele in BASES, where base calls with a quality
+        score below qCutoff are counted as N.  Quality scores were only
+        counted between the cutoffs in Q_CUTOFFS, so qCutoff must be one of
+        them.
+        """
+        assert qCutoff in Q_CUTOFFS, "qCutoff must be one of Q_CUTOFFS."
+        layer = Q_CUTOFFS.index(qCutoff)
+        calls = np.empty(self.counts.shape[:2], dtype=self.counts.dtype)
+        # in blocks of rows, so that counts in a file are not read all at once
+        for start in range(0, self.counts.shape[0], CALLS_BLOCK):
+            block = self.counts[start:(start+CALLS_BLOCK)]
+            low = block[:, :, :layer].sum(axis=2)
+            high = block[:, :, layer:].sum(axis=2)
+            high[:, GAP_INDEX] += low[:, GAP_INDEX]  # deletions have no quality
+            low[:, GAP_INDEX] = 0
+            high[:, N_INDEX] += low.sum(axis=1)
+            calls[start:(start+len(block))] = high
+        return calls
+
+    def anchors(self, qCutoff):
+        """ Return insertions as {(pos, insert): {base: count}} for qCutoff """
+        result = {}
+        for key, anchors in self.insertions.iteritems():
+            bases = result.setdefault(key, {})
+            for (base, q), count in anchors.iteritems():
+                if q < qCutoff:
+                    base = 'N'
+                bases[base] = bases.get(base, 0) + count
+        return result
+
+    def covered(self):
+        """ Return a sorted array of positions with at least one base call """
+        depth = self.counts.sum(axis=(1, 2))
+        for pos, _ in self.insertions:
+            depth[pos - self.offset] += 1
+        return np.flatnonzero(depth) + self.offset
+
+    def update(self, other):
+        """ Add the counts of another Pileup of the same reference """
+        if other.offset < self.offset:
+            raise ValueError('cannot add counts before the first position of a Pileup')
+        end = other.offset + other.counts.shape[0]
+        self.reserve(end)
+        self.counts[(other.offset-self.offset):(end-self.offset)] += other.counts
+        for key, anchors in other.insertions.iteritems():
+            total = self.insertions.setdefault(key, {})
+            for allele, count in anchors.iteritems():
+                total[allele] = total.get(allele, 0) + count
+
+    def trim(self, start=False):
+        """ Drop the rows of counts after the last covered position, and
+        before the first covered position if start is True, which moves
+        the offset """
+        keys = self.covered()
+        end = keys[-1]+1 if len(keys) else self.offset
+        first = keys[0] if start and len(keys) else self.offset
+        self.counts = self.counts[(first-self.offset):(end-self.offset)]
+        self.offset = first
+
+    def evict(self, end=None):
+        """
+        Remove the counts for positions before end (by default, all
+        positions), when no more reads will be added to them, and return
+        them as a new Pileup.
+        """
+        if end is None:
+            end = self.offset + self.counts.shape[0]
+        done = Pileup()
+        done.offset = self.offset
+        n = min(max(end - self.offset, 0), self.counts.shape[0])
+        done.counts = self.counts[:n].copy()
+        self.counts[:(self.counts.shape[0]-n)] = self.counts[n:]
+        self.counts[(self.counts.shape[0]-n):] = 0
+        self.offset = max(end, self.offset)
+        for key in [key for key in self.insertions if key[0] < end]:
+            done.insertions[key] = self.insertions.pop(key)
+        return done
+
+    def __len__(self):
+        return len(self.covered())
+
+    def __getstate__(self):
+        # most counts are zero, so only the others are sent between processes
+        state = self.__dict__.copy()
+        flat = self.counts.ravel()
+        index = np.flatnonzero(flat)
+        state['counts'] = (self.counts.shape, index, flat[index])
+        return state
+
+    def __setstate__(self, state):
+        shape, index, values = state.pop('counts')
+        self.__dict__.update(state)
+        self.counts = np.zeros(shape, dtype=np.int32)
+        self.counts.reshape(-1)[index] = values
+
+
+BASES = 'TNGCA-'  # reverse order, so that argmax breaks ties like sort(reverse=True)
+BASE_INDEX = np.array([BASES.index(chr(i).upper()) if chr(i).upper() in BASES[:-1]
+                       else BASES.index('N')
+                       for i in range(256)], dtype=np.intp)
+N_INDEX = BASES.index('N')
+GAP_INDEX = BASES.index('-')
+# quality cutoffs that a consensus can be generated for: the limits of the
+# 8 bins that Illumina instruments reduce quality scores to, and 5 and 15.
+# Counts are kept for each range between cutoffs rather than for each score,
+# which takes 240 bytes per reference position.
+Q_CUTOFFS = (0, 2, 5, 10, 15, 20, 25, 30, 35, 40)
+# layer of counts for each character of a quality string
+Q_LAYER = np.searchsorted(Q_CUTOFFS, np.maximum(np.arange(256) - 33, 0), side='right') - 1
+CALLS_BLOCK = 1 << 16  # rows of counts summed at a time by Pileup.calls()
+
+
+def add_read(pile, refpos, cigar, seq, qual):
+    """
+    Count the base calls of one aligned read in a Pileup.
+    :param pile: Pileup for the reference the read is mapped to
+    :param refpos: one-based position of the first aligned base in the reference
+    :param cigar: CIGAR string of the alignment
+    :param seq: read sequence
+    :param qual: read quality string
+    """
+    pos = 0  # position in sequence
+
+    tokens = cigar_re.findall(cigar)
+
+    if tokens[0].endswith('S'):
+        # skip left soft clip
+        pos = int(tokens[0][:-1])
+        tokens.pop(0)  # remove this first token
+
+    if not tokens[0].endswith('M'):
+        # the leftmost token must end with M
+        print 'ERROR: CIGAR token after soft clip must be match interval'
+        sys.exit()
+
+    for i, token in enumerate(tokens):
+        length = int(token[:-1])
+        if token.endswith('M'):
+            # match
+            pile.reserve(refpos+length)
+            bases = np.frombuffer(seq[pos:(pos+length)], dtype=np.uint8)
+            quals = np.frombuffer(qual[pos:(pos+length)], dtype=np.uint8)
+            alleles = BASE_INDEX[bases]
+            qbins = Q_LAYER[quals]
+            if i+1 < len(tokens) and tokens[i+1].endswith('I'):
+                # last base is recorded with the insertion that follows it
+                alleles = alleles[:-1]
+                qbins = qbins[:-1]
+            rows = np.arange(refpos, refpos+len(alleles)) - pile.offset
+            pile.counts[rows, alleles, qbins] += 1
+            pos += length
+            refpos += length
+
+        elif token.endswith('D'):
+            # deletion relative to reference
+            pile.reserve(refpos+length)
+            pile.counts[(refpos-pile.offset):(refpos+length-pile.offset), GAP_INDEX, 0] += 1
+            refpos += length
+
+        elif token.endswith('I'):
+            # insertion relative to reference
+            # FIXME: pileup does not record quality scores of inserted bases
+            insert = seq[pos:(pos+length)].upper()
+            if tokens[i-1].endswith('M'):
+                base = seq[pos-1].upper()
+                if base not in BASES[:-1]:
+                    base = 'N'
+                key = (base, ord(qual[pos-1])-33)
+                anchors = pile.insertions.setdefault((refpos-1, insert), {})
+                anchors[key] = anchors.get(key, 0) + 1
+            pos += length
+
+        elif token.endswith('S'):
+            # soft clip
+            break
+
+        else:
+            print 'ERROR: Unknown token in CIGAR string', token
+            sys.exit()
+
+
 def sam_to_pileup (handle):
     """
-    Convert a SAM-style CSV file into samtools pileup-like format in memory.
-    Process inline by region.  Also return numbers of reads mapped to each region.
-    :param sam_csv: Product of prelim_map.py or iterative remapping.
-    :return: dictionary by region, keying dictionaries of concatenated bases by position
+    Count the base calls at each position of each reference in a SAM file,
+    by quality score.  Bases are counted in bulk for each match interval of
+    a CIGAR string.  Also return numbers of reads mapped to each region.
+    :param handle: iterable over lines of SAM
+    :return: ({refname: Pileup}, {refname: mapped read count})
     """
-    pileup = {}
-    counts = {}
+    result = ({}, {})
     for rcount, row in enumerate(handle):
         if row.startswith('@'):
             continue
         qname, flag, refname, rpos, mapq, cigar, rnext, pnext, tlen, seq, qual = row.split('\t')[:11]
         if cigar == '*':
             continue  # unmapped read
+        count_read(result, refname, int(rpos), cigar, seq, qual)
+
+    return result
+
+
+def count_read(result, refname, rpos, cigar, seq, qual):
+    """
+    Add one mapped read to a result of sam_to_pileup().
+    :param result: (pileup, counts), which is modified
+    """
+    pileup, counts = result
+    if refname not in pileup:
+        pileup.update({refname: Pileup()})
+    if refname not in counts:
+        counts.update({refname: 0})
 
-        if refname not in pileup:
-            pileup.update({refname: {}})
-        if refname not in counts:
-            counts.update({refname: 0})
+    # update mapped read counts
+    counts[refname] += 1
 
+    add_read(pileup[refname], rpos, cigar, seq, qual)
 
-        # update mapped read counts
-        counts[refname] += 1
 
-        is_first = is_first_read(flag)
+def merge_pileups(total, part):
+    """
+    Add one result of sam_to_pileup() to another.  Merging is associative
+    and commutative, so partial pileups of the reads in a SAM file, or of
+    different sequencing runs, can be merged in any order.
+    :param total: (pileup, counts), which is modified
+    :param part: (pileup, counts)
+    :return: total
+    """
+    for refname, pile in part[0].iteritems():
+        if refname in total[0]:
+            total[0][refname].update(pile)
+        elif pile.offset:
+            # totals start at the first position, as save_pileup() expects
+            total[0][refname] = Pileup()
+            total[0][refname].update(pile)
+        else:
+            total[0][refname] = pile
+        total[1][refname] = total[1].get(refname, 0) + part[1][refname]
+    return total
 
-        pos = 0  # position in sequence
-        refpos = int(rpos) # position in reference
 
-        tokens = cigar_re.findall(cigar)
+def shard_ranges(path, nshards):
+    """
+    Split a file into byte ranges of about equal size that start and end on
+    line boundaries.
+    :return: list of (start, end) offsets
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as handle:
+        for i in range(1, nshards):
+            handle.seek(max(size * i // nshards - 1, bounds[-1]))
+            handle.readline()  # move to the start of the next line
+            bounds.append(max(handle.tell(), bounds[-1]))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
 
-        if tokens[0].endswith('S'):
-            # skip left soft clip
-            pos = int(tokens[0][:-1])
-            tokens.pop(0)  # remove this first token
 
-        if not tokens[0].endswith('M'):
-            # the leftmost token must end with M
-            print 'ERROR: CIGAR token after soft clip must be match interval'
-            sys.exit()
+def read_range(path, start, end):
+    """ Yield the lines of a file between two byte offsets on line boundaries """
+    with open(path, 'rb') as handle:
+        handle.seek(start)
+        while handle.tell() < end:
+            yield handle.readline()
 
-        # record start of read
-        if refpos not in pileup[refname]:
-            # keys 's' = sequence, 'q' = quality string
-            pileup[refname].update({refpos: {'s': '', 'q': ''}})
-        pileup[refname][refpos]['s'] += '^' + chr(int(mapq)+33)
-
-        for token in tokens:
-            length = int(token[:-1])
-            if token.endswith('M'):
-                # match
-                for i in range(length):
-                    if refpos not in pileup[refname]: pileup[refname].update({refpos: {'s': '', 'q': ''}})
-                    pileup[refname][refpos]['s'] += seq[pos] if is_first else seq[pos].lower()
-                    pileup[refname][refpos]['q'] += qual[pos]
-                    pos += 1
-                    refpos += 1
-
-            elif token.endswith('D'):
-                # deletion relative to reference
-                pileup[refname][refpos-1]['s'] += '-' + str(length) + ('N' if is_first else 'n')*length
-
-                # append deletion placeholders downstream
-                for i in range(refpos, refpos+length):
-                    if i not in pileup[refname]: pileup[refname].update({i: {'s': '', 'q': ''}})
-                    pileup[refname][i]['s'] += '*'
-
-                refpos += length
-
-            elif token.endswith('I'):
-                # insertion relative to reference
-                # FIXME: pileup does not record quality scores of inserted bases
-                insert = seq[pos:(pos+length)]
-                pileup[refname][refpos-1]['s'] += '+' + str(length) + (insert if is_first else insert.lower())
-                pos += length
-
-            elif token.endswith('S'):
-                # soft clip
-                break
 
-            else:
-                print 'ERROR: Unknown token in CIGAR string', token
-                sys.exit()
+def pileup_range(job):
+    """
+    Build a partial pileup from the lines of a SAM file in a byte range.
+    :param job: (path, start, end)
+    :return: ({refname: Pileup}, {refname: mapped read count})
+    """
+    pileup, counts = sam_to_pileup(read_range(*job))
+    for pile in pileup.itervalues():
+        pile.trim(start=True)  # send back only the positions in this range
+    return pileup, counts
+
+
+def parallel_pileup(path, threads, nshards=None):
+    """
+    Build the pileups of a SAM file in a pool of worker processes, each
+    counting the reads in a range of lines, and merge the partial results.
+    :param path: path to SAM file
+    :param threads: number of worker processes
+    :param nshards: number of byte ranges, by default 1 per process
+    :return: ({refname: Pileup}, {refname: mapped read count})
+    """
+    jobs = [(path,) + bounds for bounds in shard_ranges(path, nshards or threads)]
+    pool = multiprocessing.Pool(threads)
+    try:
+        result = reduce(merge_pileups, pool.imap_unordered(pileup_range, jobs), ({}, {}))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return result
+
+
+def build_pileup(path, threads=1):
+    """
+    Build the pileups of a SAM or BAM file, splitting a SAM file among
+    worker processes if threads > 1.
+    :param path: path to SAM or BAM file, or '-' to read SAM from stdin
+    :return: ({refname: Pileup}, {refname: mapped read count})
+    """
+    if threads > 1 and path != '-' and not is_bam(path):
+        return parallel_pileup(path, threads)
+    return sam_to_pileup(open_alignments(path))
 
-        # record end of read
-        pileup[refname][refpos-1]['s'] += '$'
 
+def cache_key(path):
+    """ Return a hex digest of the contents of a file, for naming cache entries """
+    digest = hashlib.sha1('adapt-ref pileup v%d' % CACHE_VERSION)
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(1 << 20), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def save_pileup(handle, pileup, counts):
+    """
+    Write pileups and mapped read counts to an open file in NumPy .npz format.
+    Base call counts are trimmed to the last covered position.
+    """
+    arrays = {'refnames': np.array(sorted(pileup), dtype=str)}
+    arrays['mapped'] = np.array([counts[refname] for refname in arrays['refnames']],
+                                dtype=np.int64)
+    for i, refname in enumerate(arrays['refnames']):
+        pile = pileup[refname]
+        pile.trim()
+        arrays['counts%d' % i] = pile.counts
+        rows = [(pos, insert, base, q, count)
+                for (pos, insert), anchors in pile.insertions.iteritems()
+                for (base, q), count in anchors.iteritems()]
+        pos, insert, base, q, count = zip(*rows) if rows else ([], [], [], [], [])
+        arrays['ins_pos%d' % i] = np.array(pos, dtype=np.int64)
+        arrays['ins_insert%d' % i] = np.array(insert, dtype=str)
+        arrays['ins_base%d' % i] = np.array(base, dtype=str)
+        arrays['ins_q%d' % i] = np.array(q, dtype=np.int64)
+        arrays['ins_count%d' % i] = np.array(count, dtype=np.int64)
+    np.savez_compressed(handle, **arrays)
+
+
+def load_pileup(handle):
+    """ Read pileups and mapped read counts written by save_pileup() """
+    pileup = {}
+    counts = {}
+    with np.load(handle) as arrays:
+        for i, refname in enumerate(arrays['refnames']):
+            pile = Pileup()
+            pile.counts = arrays['counts%d' % i]
+            if pile.counts.shape[2] != len(Q_CUTOFFS):
+                raise ValueError('pileup was saved with other quality bins, save it again')
+            for pos, insert, base, q, count in zip(
+                    arrays['ins_pos%d' % i], arrays['ins_insert%d' % i],
+                    arrays['ins_base%d' % i], arrays['ins_q%d' % i],
+                    arrays['ins_count%d' % i]):
+                anchors = pile.insertions.setdefault((int(pos), str(insert)), {})
+                anchors[(str(base), int(q))] = int(count)
+            pileup[str(refname)] = pile
+            counts[str(refname)] = int(arrays['mapped'][i])
     return pileup, counts
 
 
+def evict_cache(cachedir, max_size):
+    """
+    Remove least recently used entries from a pileup cache until the total
+    size of entries is no more than max_size bytes.  The most recent entry is
+    always kept.
+    """
+    entries = []
+    for filename in os.listdir(cachedir):
+        if filename.endswith('.npz'):
+            path = os.path.join(cachedir, filename)
+            entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries[:-1]:
+        if total <= max_size:
+            break
+        os.remove(path)
+        total -= size
+
+
+def cached_pileup(path, cachedir, max_size, threads=1):
+    """
+    Return the pileups of a SAM or BAM file from a cache of previous results
+    in cachedir, keyed by the contents of the file, or generate and cache them
+    with build_pileup().
+    :param path: path to SAM or BAM file
+    :param cachedir: directory of cache entries, created if necessary
+    :param max_size: maximum total size of cache entries in bytes
+    :param threads: number of processes used to build pileups
+    :return: ({refname: Pileup}, {refname: mapped read count})
+    """
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    entry = os.path.join(cachedir, cache_key(path) + '.npz')
+    if os.path.exists(entry):
+        os.utime(entry, None)  # mark as recently used
+        return load_pileup(entry)
+
+    pileup, counts = build_pileup(path, threads)
+    fd, tmpfile = tempfile.mkstemp(dir=cachedir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as handle:
+        save_pileup(handle, pileup, counts)
+    os.rename(tmpfile, entry)
+    evict_cache(cachedir, max_size)
+    return pileup, counts
+
+
+class StoredPileup(Pileup):
+    """
+    A Pileup whose counts are memory-mapped from a file, which grows as
+    positions are added.  The file starts with a header (see STORE_HEADER)
+    followed by the counts in C order.  Insertions are kept in memory and
+    saved by PileupStore.
+    """
+    def __init__(self, path, insertions=None):
+        Pileup.__init__(self)
+        self.path = path
+        self.insertions = insertions or {}
+        if not os.path.exists(path):
+            with open(path, 'wb') as handle:
+                handle.write(STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, 0,
+                                               len(BASES), len(Q_CUTOFFS)))
+        self._map()
+
+    def _map(self, mode='r+'):
+        with open(self.path, 'rb') as handle:
+            magic, version, nrows, nalleles, nquals = STORE_HEADER.unpack(
+                handle.read(STORE_HEADER.size))
+        if magic != STORE_MAGIC or version != STORE_VERSION or \
+                (nalleles, nquals) != (len(BASES), len(Q_CUTOFFS)):
+            raise ValueError('%s is not a pileup store file of this version' % self.path)
+        if nrows == 0:
+            self.counts = np.zeros((0, nalleles, nquals), dtype=np.int32)
+        else:
+            self.counts = np.memmap(self.path, dtype=np.int32, mode=mode,
+                                    offset=STORE_HEADER.size, shape=(nrows, nalleles, nquals))
+
+    def reserve(self, end):
+        """ Make sure that positions up to end can be counted, growing the file """
+        if end > self.counts.shape[0]:
+            nrows = max(end, 2*self.counts.shape[0])
+            self.flush()
+            self.counts = None  # release the memory map before resizing
+            with open(self.path, 'r+b') as handle:
+                handle.write(STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, nrows,
+                                               len(BASES), len(Q_CUTOFFS)))
+                handle.truncate(STORE_HEADER.size + nrows * len(BASES) * len(Q_CUTOFFS) * 4)
+            self._map()
+
+    def flush(self):
+        """ Write changes to the counts to disk """
+        if isinstance(self.counts, np.memmap):
+            self.counts.flush()
+
+    def trim(self, start=False):
+        pass  # rows are kept for future reads
+
+    def __getstate__(self):
+        # worker processes map the file again, instead of receiving a copy
+        return {'path': self.path, 'insertions': self.insertions}
+
+    def __setstate__(self, state):
+        Pileup.__init__(self)
+        self.path = state['path']
+        self.insertions = state['insertions']
+        self._map(mode='r')
+
+
+class PileupStore(object):
+    """
+    A directory of pileups that SAM files can be added to incrementally.
+    The counts for each reference are in a memory-mapped StoredPileup file,
+    and the index file records the reference names, their files, mapped read
+    counts and insertions, and the digests of the SAM files added so far.
+    """
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.index_path = os.path.join(path, 'index.json')
+        self.index = {'refs': {}, 'sources': []}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rU') as handle:
+                self.index = json.load(handle)
+
+    def pileups(self):
+        """ Return ({refname: StoredPileup}, {refname: mapped read count}) """
+        pileup = {}
+        counts = {}
+        for refname, entry in self.index['refs'].iteritems():
+            insertions = {}
+            for pos, insert, base, q, count in entry['insertions']:
+                anchors = insertions.setdefault((pos, str(insert)), {})
+                anchors[(str(base), q)] = count
+            pileup[str(refname)] = StoredPileup(os.path.join(self.path, entry['file']), insertions)
+            counts[str(refname)] = entry['mapped']
+        return pileup, counts
+
+    def add(self, pileup, counts, source=None):
+        """
+        Add pileups to the store.
+        :param source: digest of the SAM file the pileups came from, if any
+        :return: False if the source was already added, otherwise True
+        """
+        if source is not None and source in self.index['sources']:
+            return False
+        stored, mapped = self.pileups()
+        for refname, pile in pileup.iteritems():
+            if refname not in stored:
+                filename = '%d.counts' % len(self.index['refs'])
+                stored[refname] = StoredPileup(os.path.join(self.path, filename))
+                self.index['refs'][refname] = {'file': filename}
+                mapped[refname] = 0
+            stored[refname].update(pile)
+            stored[refname].flush()
+            entry = self.index['refs'][refname]
+            entry['mapped'] = mapped[refname] + counts[refname]
+            entry['insertions'] = [[pos, insert, base, q, count]
+                                   for (pos, insert), anchors in stored[refname].insertions.iteritems()
+                                   for (base, q), count in anchors.iteritems()]
+        if source is not None:
+            self.index['sources'].append(source)
+
+        # replace the index in one step, so that it always matches the counts
+        fd, tmpfile = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as handle:
+            json.dump(self.index, handle)
+        os.rename(tmpfile, self.index_path)
+        return True
+
+
+STORE_HEADER = struct.Struct('<4sIIII12x')  # magic, version, rows, alleles, quality scores
+STORE_MAGIC = 'PILE'
+STORE_VERSION = 2
+
+
+class ConsensusBuilder(object):
+    """
+    Assemble a consensus sequence from tokens in order of reference position,
+    in a single pass.  Gaps between positions are filled with N, and runs of
+    deletions that are a multiple of 3 and lie between two unambiguous bases
+    are removed to preserve the reading frame.  A run of deletions is held
+    back until the next token decides whether it is in-frame.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.last_pos = 0
+        self.last_base = ''  # base preceding any pending deletions
+        self.deletions = 0  # length of pending run of deletions
+
+    def add(self, pos, token):
+        """
+        Append the consensus token for a reference position.
+        :param pos: one-based reference position, greater than the last one
+        :param token: '-' for a deletion, otherwise one or more bases
+        """
+        if (pos - self.last_pos) > 1:
+            self._append('N' * (pos - self.last_pos - 1))
+        self.last_pos = pos
+        if token == '-':
+            self.deletions += 1
+        else:
+            self._append(token)
+
+    def _append(self, bases):
+        if self.deletions:
+            if not (self.deletions % 3 == 0 and self.last_base and self.last_base in 'ACGT' and bases[0] in 'ACGT'):
+                self.chunks.append('-' * self.deletions)
+            self.deletions = 0
+        self.chunks.append(bases)
+        self.last_base = bases[-1]
+
+    def result(self):
+        """ Return the consensus sequence assembled so far """
+        return ''.join(self.chunks) + '-' * self.deletions
+
 
 def pileup_to_conseq (pileup, qCutoff):
     """
-    Generate a consensus sequence from a samtools pileup file.
-    Each line in a pileup file corresponds to a nucleotide position in the
-     reference.
-    Tokens are interpreted as follows:
-    ^               start of read
-    $               end of read
-    +[1-9]+[ACGT]+  insertion relative to ref of length \1 and substring \2
-    -[1-9]+N+  deletion relative to ref of length \1 and substring \2
-    *               placeholder for deleted base
+    Generate a consensus sequence from the base counts in a Pileup,
+    where base calls with a quality score below qCutoff are counted as N.
+    The consensus at each position is the most common allele, where a base
+    followed by an insertion counts as a separate allele, and ties are broken
+    in favour of the allele that sorts last.  Deletions are reported as '-'.
 
     FIXME: this cannot handle combinations of insertions (e.g., 1I3M2I)
     because a pileup loses all linkage information.  For now we have to
     restrict all insertions to those divisible by 3 to enforce a reading
     frame.
     """
-    conseqs = {}
-    to_skip = 0
-    last_pos = 0
+    builder = ConsensusBuilder()
+    for pos, token in consensus_tokens(pileup, qCutoff):
+        builder.add(pos, token)
+    return builder.result()
 
-    conseq = ''
-    keys = pileup.keys()
-    keys.sort()
 
+def consensus_tokens(pileup, qCutoff):
+    """
+    Yield (position, token) for each covered position of a Pileup in order,
+    where the token is the consensus base or '-', followed by any insertion
+    that retains the reading frame.  See pileup_to_conseq().
+    """
+    keys = pileup.covered()
+    calls = pileup.calls(qCutoff)
+    best = calls.argmax(axis=1)
+    # alleles are compared by count, then by pileup notation (e.g., A+3ACG)
+    alleles = {}
     for pos in keys:
-        astr = pileup[pos]['s']
-        qstr = pileup[pos]['q']
+        row = pos - pileup.offset
+        alleles[pos] = (calls[row, best[row]], BASES[best[row]], BASES[best[row]], '')
+    for (pos, insert), anchors in pileup.anchors(qCutoff).iteritems():
+        for base, count in anchors.iteritems():
+            allele = (count, '%s+%d%s' % (base, len(insert), insert), base, insert)
+            alleles[pos] = max(alleles[pos], allele)
+
+    for pos in keys:
+        count, _, base, insert = alleles[pos]
+        if count == 0:
+            base = 'N'
+        if len(insert) % 3 == 0:
+            # only add insertions that retain reading frame
+            base += insert
+        yield pos, base
+
+
+def read_header(handle):
+    """
+    Read the header of a SAM file.
+    :param handle: iterable over lines of SAM
+    :return: (list of header lines, iterator over all lines including header)
+    """
+    lines = iter(handle)
+    header = []
+    for line in lines:
+        if not line.startswith('@'):
+            return header, itertools.chain(header, [line], lines)
+        header.append(line)
+    return header, iter(header)
 
-        if to_skip > 0:
-            to_skip -= 1
+
+def is_coordinate_sorted(header):
+    """ Return True if a SAM header declares sorting by coordinate """
+    for line in header:
+        if line.startswith('@HD'):
+            return 'SO:coordinate' in line.rstrip('\n').split('\t')
+    return False
+
+
+def stream_conseqs(handle, qCutoff, flush_size=4096):
+    """
+    Generate consensus sequences from a coordinate-sorted SAM file while
+    reading it.  Positions to the left of the current read are final, so
+    their counts are passed to a ConsensusBuilder and dropped, and memory is
+    bounded by the span of overlapping reads instead of the genome length.
+    :param handle: iterable over lines of coordinate-sorted SAM
+    :param qCutoff: quality score cutoff
+    :param flush_size: number of final positions to accumulate before
+                       passing them on
+    :yield: (refname, consensus sequence, number of covered positions)
+    :raise ValueError: if the reads are not sorted by coordinate
+    """
+    stream = ConsensusStream(qCutoff, flush_size)
+    for row in handle:
+        if row.startswith('@'):
             continue
+        qname, flag, rname, rpos, mapq, cigar, rnext, pnext, tlen, seq, qual = row.split('\t')[:11]
+        if cigar == '*':
+            continue  # unmapped read
+        for result in stream.add(rname, int(rpos), cigar, seq, qual):
+            yield result
 
-        if (pos - last_pos) > 1:
-            conseq += 'N' * (pos - last_pos - 1)
-        last_pos = pos
-        alist = []  # alist stores all bases at a given coordinate
-        i = 0       # Current index for astr
-        j = 0       # Current index for qstr
-
-        while i < len(astr):
-            if astr[i] == '^':
-                q = ord(qstr[j])-33
-                base = astr[i+2] if q >= qCutoff else 'N'
-                alist.append(base.upper())
-                i += 3
-                j += 1
-            elif astr[i] in '*':
-                alist.append('-')
-                i += 1
-            elif astr[i] == '$':
-                i += 1
-            elif i < len(astr)-1 and astr[i+1] in '+-':
-                # i-th base is followed by an indel indicator
-                m = indel_re.match(astr[i+1:])
-                indel_len = int(m.group().strip('+-'))
-                left = i+1 + len(m.group())
-                insertion = astr[left:(left+indel_len)]
-                q = ord(qstr[j])-33
-                base = astr[i].upper() if q >= qCutoff else 'N'
-                token = base + m.group() + insertion.upper()  # e.g., A+3ACG
-                if astr[i+1] == '+':
-                    alist.append(token)
-                else:
-                    alist.append(base)
-                i += len(token)
-                j += 1
-            else:
-                # Operative case: sequence matches reference (And no indel ahead)
-                try:
-                    q = ord(qstr[j])-33
-                except:
-                    print astr[i]
-                    print qstr
-                    print i, j
-                    raise
-                base = astr[i].upper() if q >= qCutoff else 'N'
-                alist.append(base)
-                i += 1
-                j += 1
-
-        atypes = set(alist)
-        intermed = []
-        for atype in atypes:
-            intermed.append((alist.count(atype), atype))
-        intermed.sort(reverse=True)
-
-        if intermed:
-            token = intermed[0][1]
-        else:
-            token = 'N'
-
-        if '+' in token:
-            m = indel_re.findall(token)[0] # \+[0-9]+
-            conseq += token[0]
-            if int(m) % 3 == 0:
-                # only add insertions that retain reading frame
-                conseq += token[1+len(m):]
-        elif token == '-':
-            conseq += '-'
-        else:
-            conseq += token
+    for result in stream.close():
+        yield result
+
+
+class ConsensusStream(object):
+    """
+    The state of stream_conseqs() between reads, for callers that pass
+    reads in one at a time instead of handing over an iterable of lines.
+    """
+    def __init__(self, qCutoff, flush_size=4096):
+        self.qCutoff = qCutoff
+        self.flush_size = flush_size
+        self.refname = None
+        self.done = set()
+
+    def add(self, rname, rpos, cigar, seq, qual):
+        """
+        Add a mapped read.
+        :return: list of (refname, consensus sequence, number of covered
+                 positions) for a reference that the read has finished
+        :raise ValueError: if the reads are not sorted by coordinate
+        """
+        finished = []
+        if rname != self.refname:
+            if self.refname is not None:
+                finished = self.close()
+                self.done.add(self.refname)
+            if rname in self.done:
+                raise ValueError('SAM file is not sorted by coordinate')
+            self.refname = rname
+            self.pile = Pileup()
+            self.pile.offset = rpos
+            self.builder = ConsensusBuilder()
+            self.ncovered = 0
+        elif rpos < self.last_pos:
+            raise ValueError('SAM file is not sorted by coordinate')
+        self.last_pos = rpos
 
-        # remove in-frame deletions (multiples of 3), if any
-        pat = re.compile('([ACGT])(---)+([ACGT])')
-        conseq = re.sub(pat, r'\g<1>\g<3>', conseq)
+        if rpos - self.pile.offset >= self.flush_size:
+            self.ncovered += _flush(self.pile, self.builder, self.qCutoff, rpos)
+        add_read(self.pile, rpos, cigar, seq, qual)
+        return finished
 
-    return conseq
+    def close(self):
+        """ Finish the current reference, and return its result as add() does """
+        if self.refname is None:
+            return []
+        self.ncovered += _flush(self.pile, self.builder, self.qCutoff)
+        return [(self.refname, self.builder.result(), self.ncovered)]
+
+
+def _flush(pile, builder, qCutoff, end=None):
+    """ Pass the counts for positions before end (or all positions) from a
+    Pileup to a ConsensusBuilder, and return the number of covered positions """
+    ncovered = 0
+    for pos, token in consensus_tokens(pile.evict(end), qCutoff):
+        builder.add(pos, token)
+        ncovered += 1
+    return ncovered
 
 
 def convert_fasta (handle):
@@ -259,21 +838,62 @@ def get_boundaries(str):
     return res
 
 
-def update_reference(reference, conseq):
-    #alignment = pairwise2.align.localxx(reference, conseq)  # too slow!!!
-    tempdir = os.getcwd()
-    infile = os.path.join(tempdir, 'remap.fa')
-    outfile = infile.replace('.fa', '.mafft.fa')
-    with open(infile, 'w') as handle:
-        handle.write('>ref\n%s\n>conseq\n%s\n' % (reference, conseq))
+def mafft_align(reference, conseq):
+    """
+    Align the consensus to the reference with MAFFT, in a private temporary
+    directory so that concurrent runs do not overwrite each other's files.
+    :return: {'ref': aligned reference, 'conseq': aligned consensus}
+    """
+    workdir = tempfile.mkdtemp(dir=scratch or tempdir)
+    try:
+        infile = os.path.join(workdir, 'remap.fa')
+        outfile = infile.replace('.fa', '.mafft.fa')
+        with open(infile, 'w') as handle:
+            handle.write('>ref\n%s\n>conseq\n%s\n' % (reference, conseq))
 
-    os.system('mafft --quiet %s > %s' % (infile, outfile))
-    #os.system('muscle -quiet -in %s -out %s' % (infile, outfile))
-    with open(outfile, 'rU') as handle:
-        fasta = dict([(h, s.upper()) for h, s in convert_fasta(handle)])
+        os.system('mafft --quiet %s > %s' % (infile, outfile))
+        #os.system('muscle -quiet -in %s -out %s' % (infile, outfile))
+        with open(outfile, 'rU') as handle:
+            return dict([(h, s.upper()) for h, s in convert_fasta(handle)])
+    finally:
+        shutil.rmtree(workdir)
 
 
-    # use the aligned sequences to update the reference
+def update_reference(reference, conseq, band=100, use_mafft=False):
+    """
+    Align the consensus to the reference and replace the reference bases
+    covered by the consensus, keeping reference bases where the consensus
+    is ambiguous (N).
+    The consensus is already in reference coordinates, so by default it is
+    aligned in-process by a banded aligner, which is global in the consensus
+    and free of end gap penalties in the reference.  Gaps in the consensus
+    are deletions at known positions, so they are kept in the query as
+    ambiguous positions that align to the deleted reference bases.  An
+    ambiguous position that the banded aligner cannot place opposite a
+    reference base is dropped rather than inserted into the reference,
+    whereas MAFFT alignments insert consensus Ns as they always have.
+    :param band: maximum distance of the alignment from the diagonal
+    :param use_mafft: align with MAFFT instead
+    :return: (updated reference, number of differences)
+    """
+    if use_mafft:
+        fasta = mafft_align(reference, conseq)
+    else:
+        aref, aconseq, _ = banded_align.align(reference.replace('-', '').upper(),
+                                              conseq.upper(), band)
+        columns = [(b1, b2) for b1, b2 in itertools.izip(aref, aconseq)
+                   if b1 != '-' or b2 not in 'N-']
+        aref, aconseq = [''.join(bases) for bases in zip(*columns)] if columns else ('', '')
+        fasta = {'ref': aref, 'conseq': aconseq}
+    return merge_alignment(fasta)
+
+
+def merge_alignment(fasta):
+    """
+    Use the aligned sequences to update the reference.
+    :param fasta: {'ref': aligned reference, 'conseq': aligned consensus}
+    :return: (updated reference, number of differences)
+    """
     left, right = get_boundaries(fasta['conseq'])
     newseq = fasta['ref'][:left]
     ndiff = 0
@@ -300,35 +920,158 @@ def update_reference(reference, conseq):
     return newseq, ndiff
 
 
+def init_worker(rundir):
+    """ Give a worker process its own scratch directory within rundir """
+    global scratch
+    scratch = tempfile.mkdtemp(dir=rundir)
+
+
+def adapt_reference(job):
+    """
+    Generate the consensus of one reference and update the reference with it.
+    :param job: (refname, refseq, source, qCutoff, band, use_mafft), where
+                source is a Pileup or (consensus sequence, covered positions)
+    :return: (refname, updated reference, number of differences,
+              number of covered positions)
+    """
+    refname, refseq, source, qCutoff, band, use_mafft = job
+    if isinstance(source, Pileup):
+        conseq, ncovered = pileup_to_conseq(source, qCutoff), len(source)
+    else:
+        conseq, ncovered = source
+    newseq, ndiff = update_reference(refseq, conseq, band, use_mafft)
+    return refname, newseq, ndiff, ncovered
+
+
+def adapt_references(jobs, threads=1):
+    """
+    Apply adapt_reference() to each job, in a pool of worker processes if
+    threads > 1.  Results are yielded in the same order as the jobs.
+    """
+    if threads <= 1:
+        for job in jobs:
+            yield adapt_reference(job)
+        return
+
+    rundir = tempfile.mkdtemp(dir=tempdir)
+    pool = multiprocessing.Pool(threads, init_worker, (rundir,))
+    try:
+        for result in pool.imap(adapt_reference, jobs):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(rundir)
+
+
+def write_references(out, refs, sources, qCutoff, band=100, use_mafft=False, threads=1):
+    """
+    Update every reference with reads mapped to it, and write the updated
+    references in the order of the input FASTA.
+    :param out: open file to write FASTA to
+    :param refs: list of (refname, reference sequence)
+    :param sources: {refname: source}, where source is as in adapt_reference()
+    """
+    refseqs = dict(refs)
+    order = dict((refname, i) for i, (refname, _) in enumerate(refs))
+    refnames = sorted(sources, key=lambda refname: order.get(refname, len(order)))
+    jobs = ((refname, refseqs[refname], sources[refname], qCutoff, band, use_mafft)
+            for refname in refnames)
+    for refname, newseq, ndiff, ncovered in adapt_references(jobs, threads):
+        out.write('>%s\n%s\n' % (refname, newseq))
+
+        # how many changes were there?
+        print '%s, original length %d' % (refname, len(refseqs[refname]))
+        print 'Reads cover interval of length', ncovered
+        print 'Updated reference with', ndiff, 'differences'
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Generate a new reference sequence from the consensus '
                     'of reads that were mapped to the current reference.'
     )
-    parser.add_argument('sam', type=argparse.FileType('rU'),
-                        help='<input> SAM file')
+    parser.add_argument('sam', type=str,
+                        help='<input> SAM or BAM file')
     parser.add_argument('ref', type=argparse.FileType('rU'),
                         help='<input> FASTA file containing reference')
     parser.add_argument('out', type=argparse.FileType('w'),
                         help='<output> FASTA file with updated reference')
     parser.add_argument('-qcut', type=int, default=10,
-                        help="<option> Quality score cutoff")
+                        help="<option> Quality score cutoff, one of %s" %
+                             ', '.join(map(str, Q_CUTOFFS)))
+    parser.add_argument('-cache_dir', default=os.path.join(tempdir, 'adapt-ref-cache'),
+                        help="<option> Directory for caching pileups by SAM file contents")
+    parser.add_argument('-cache_size', type=int, default=1024,
+                        help="<option> Maximum size of pileup cache in MB")
+    parser.add_argument('-no_cache', action='store_true',
+                        help="<option> Do not read or write the pileup cache")
+    parser.add_argument('-band', type=int, default=100,
+                        help="<option> Band width for aligning consensus to reference")
+    parser.add_argument('-mafft', action='store_true',
+                        help="<option> Align consensus to reference with MAFFT")
+    parser.add_argument('-no_stream', action='store_true',
+                        help="<option> Do not stream coordinate-sorted input, "
+                             "load the whole pileup (and use the cache) instead")
+    parser.add_argument('-threads', type=int, default=1,
+                        help="<option> Number of processes used to build pileups from "
+                             "parts of a SAM file, and to generate consensus sequences "
+                             "and update references in parallel")
+    parser.add_argument('-add_pileup', nargs='+', default=[],
+                        help="<option> Pileup files saved by -save_pileup from other "
+                             "sequencing runs, to add to the pileup of this SAM file")
+    parser.add_argument('-save_pileup', type=argparse.FileType('wb'),
+                        help="<output> File to save the (combined) pileup in")
+    parser.add_argument('-store', default=None,
+                        help="<option> Directory of a pileup store to add this SAM file "
+                             "to; consensus sequences are generated from all of the "
+                             "reads in the store")
     args = parser.parse_args()
+    if args.qcut not in Q_CUTOFFS:
+        # pileups only count quality scores between these cutoffs
+        print 'ERROR: -qcut must be one of %s' % ', '.join(map(str, Q_CUTOFFS))
+        sys.exit()
 
     # load the reference sequences
-    refseqs = dict([(h.split()[0], s) for h, s in convert_fasta(args.ref)])
+    refs = [(h.split()[0], s) for h, s in convert_fasta(args.ref)]
 
     # analyze the sequences
-    pileup, counts = sam_to_pileup(args.sam)
-    for refname, pile in pileup.iteritems():
-        conseq = pileup_to_conseq(pile, args.qcut)
-        newseq, ndiff = update_reference(refseqs[refname], conseq)
-        args.out.write('>%s\n%s\n' % (refname, newseq))
+    header, lines = read_header(open_alignments(args.sam))
+    sources = None
+    stream = not (args.no_stream or args.add_pileup or args.save_pileup or args.store)
+    if is_coordinate_sorted(header) and stream:
+        try:
+            sources = dict((refname, (conseq, ncovered))
+                           for refname, conseq, ncovered in stream_conseqs(lines, args.qcut))
+        except ValueError:
+            if args.sam == '-':
+                print 'ERROR: SAM input declared as sorted by coordinate is not sorted'
+                sys.exit()
+            print 'WARNING: SAM file is not sorted by coordinate, loading whole pileup'
+            lines = open_alignments(args.sam)
 
-        # how many changes were there?
-        print '%s, original length %d' % (refname, len(refseqs[refname]))
-        print 'Reads cover interval of length', len(pile)
-        print 'Updated reference with', ndiff, 'differences'
+    if sources is None:
+        if args.sam == '-':
+            result = sam_to_pileup(lines)
+        elif args.no_cache:
+            result = build_pileup(args.sam, args.threads)
+        else:
+            result = cached_pileup(args.sam, args.cache_dir, args.cache_size * 1024**2,
+                                   args.threads)
+        for path in args.add_pileup:
+            result = merge_pileups(result, load_pileup(path))
+        if args.save_pileup:
+            save_pileup(args.save_pileup, *result)
+            args.save_pileup.close()
+        if args.store:
+            store = PileupStore(args.store)
+            if not store.add(*result, source=None if args.sam == '-' else cache_key(args.sam)):
+                print 'WARNING: %s was already added to pileup store' % args.sam
+            result = store.pileups()
+        sources, counts = result
+
+    write_references(args.out, refs, sources, args.qcut, args.band, args.mafft, args.threads)
 
 
 if __name__ == '__main__':
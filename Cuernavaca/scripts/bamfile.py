@@ -0,0 +1,400 @@
+"""
+Read BAM files without pysam or samtools.
+
+BAM is the binary, BGZF-compressed form of SAM.  A BGZF file is a series of
+gzip blocks of at most 64 kB, so blocks can be decompressed independently in
+a pool of threads.  Positions in the file are given as virtual offsets: the
+offset of a compressed block in the file shifted left by 16 bits, plus the
+offset within the uncompressed block.  A BAM index (.bai) lists the chunks
+of virtual offsets that hold the alignments in each bin of each reference,
+so that a region of the reference can be read without scanning the file.
+
+Alignments are converted back into lines of SAM text, so that scripts that
+parse SAM can read BAM files through open_alignments().  Optional tags are
+not decoded.
+"""
+import os
+import sys
+import zlib
+import struct
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+BGZF_MAGIC = '\x1f\x8b\x08\x04'
+CIGAR_OPS = 'MIDNSHP=X'
+REF_CONSUMING = set('MDN=X')
+SEQ_CODES = '=ACMGRSVTWYHKDBN'
+# each byte of a packed sequence holds two bases
+SEQ_TABLE = [SEQ_CODES[i >> 4] + SEQ_CODES[i & 0xF] for i in range(256)]
+QUAL_TABLE = ''.join(chr(min(i+33, 126)) for i in range(256))
+CORE_FORMAT = struct.Struct('<iiBBHHHiiii')
+
+
+def inflate(cdata):
+    """ Decompress the raw deflate data of one BGZF block """
+    return zlib.decompress(cdata, -15)
+
+
+class BgzfReader(object):
+    """ Sequential and random access reader for a BGZF file.
+
+    Compressed blocks are read in batches and decompressed in a pool of
+    threads; zlib releases the interpreter lock, so the blocks of a batch are
+    decompressed in parallel.
+    """
+    def __init__(self, handle, threads=1):
+        """
+        :param handle: file opened in binary mode
+        :param threads: number of threads used to decompress blocks
+        """
+        self.handle = handle
+        self.pool = ThreadPool(threads) if threads > 1 else None
+        self.batch_size = 4 * threads
+        self.pending = deque()  # (block_offset, next_block_offset, data)
+        self.block_offset = 0
+        self.next_block_offset = 0
+        self.block = ''
+        self.within = 0
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.handle.close()
+
+    def _read_raw_block(self):
+        """ Return (block_offset, cdata) for the next compressed block, or
+        None at the end of the file """
+        block_offset = self.handle.tell()
+        header = self.handle.read(12)
+        if len(header) < 12:
+            return None
+        if header[:4] != BGZF_MAGIC:
+            raise IOError('Invalid BGZF block at offset {} in {}.'.format(
+                block_offset, self.handle.name))
+        xlen, = struct.unpack('<H', header[10:12])
+        extra = self.handle.read(xlen)
+        bsize = None
+        i = 0
+        while i < xlen:
+            subfield_id, subfield_length = struct.unpack('<2sH', extra[i:(i+4)])
+            if subfield_id == 'BC':
+                bsize, = struct.unpack('<H', extra[(i+4):(i+6)])
+            i += 4 + subfield_length
+        if bsize is None:
+            raise IOError('Missing BGZF block size at offset {} in {}.'.format(
+                block_offset, self.handle.name))
+        remainder = self.handle.read(bsize + 1 - 12 - xlen)
+        return block_offset, remainder[:-8]
+
+    def _next_block(self):
+        """ Move to the next decompressed block, returning False at the end
+        of the file """
+        if not self.pending:
+            raw_blocks = []
+            while len(raw_blocks) < self.batch_size:
+                raw_block = self._read_raw_block()
+                if raw_block is None:
+                    break
+                raw_blocks.append(raw_block)
+            if not raw_blocks:
+                return False
+            cdatas = [cdata for _, cdata in raw_blocks]
+            datas = self.pool.map(inflate, cdatas) if self.pool else map(inflate, cdatas)
+            offsets = [offset for offset, _ in raw_blocks] + [self.handle.tell()]
+            for i, data in enumerate(datas):
+                self.pending.append((offsets[i], offsets[i+1], data))
+        self.block_offset, self.next_block_offset, self.block = self.pending.popleft()
+        self.within = 0
+        return True
+
+    def read(self, size):
+        """ Read up to size uncompressed bytes """
+        chunks = []
+        while size > 0:
+            if self.within >= len(self.block) and not self._next_block():
+                break
+            chunk = self.block[self.within:(self.within+size)]
+            self.within += len(chunk)
+            size -= len(chunk)
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def seek(self, virtual_offset):
+        """ Move to a virtual offset """
+        self.handle.seek(virtual_offset >> 16)
+        self.pending.clear()
+        self.block = ''
+        self.within = 0
+        self._next_block()
+        self.within = virtual_offset & 0xFFFF
+
+    def tell(self):
+        """ Return the current virtual offset """
+        if self.within >= len(self.block):
+            return self.next_block_offset << 16
+        return (self.block_offset << 16) | self.within
+
+
+def reg2bins(beg, end):
+    """ List the bins that may hold alignments overlapping [beg, end), as in
+    the SAM specification """
+    bins = [0]
+    end -= 1
+    for shift, offset in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+
+def read_index(handle):
+    """
+    Parse a BAM index.
+    :param handle: .bai file opened in binary mode
+    :return: list with one (bins, intervals) tuple per reference, where bins
+        is {bin: [(chunk_begin, chunk_end)]} in virtual offsets, and intervals
+        is the linear index of smallest virtual offsets per 16 kb window
+    """
+    if handle.read(4) != 'BAI\1':
+        raise IOError('Invalid BAM index {}.'.format(handle.name))
+    n_ref, = struct.unpack('<i', handle.read(4))
+    index = []
+    for _ in range(n_ref):
+        bins = {}
+        n_bin, = struct.unpack('<i', handle.read(4))
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack('<Ii', handle.read(8))
+            chunks = struct.unpack('<%dQ' % (2*n_chunk), handle.read(16*n_chunk))
+            bins[bin_id] = zip(chunks[::2], chunks[1::2])
+        n_intv, = struct.unpack('<i', handle.read(4))
+        intervals = struct.unpack('<%dQ' % n_intv, handle.read(8*n_intv))
+        index.append((bins, intervals))
+    return index
+
+
+class BamReader(object):
+    """ Reader for BAM files that yields alignments as lines of SAM text.
+
+    Attributes:
+        text: header text stored in the BAM file
+        references: list of (refname, length) tuples
+    """
+    def __init__(self, path, threads=1):
+        self.path = path
+        self.bgzf = BgzfReader(open(path, 'rb'), threads)
+        if self.bgzf.read(4) != 'BAM\1':
+            raise IOError('Invalid BAM file {}.'.format(path))
+        l_text, = struct.unpack('<i', self.bgzf.read(4))
+        self.text = self.bgzf.read(l_text).rstrip('\0')
+        n_ref, = struct.unpack('<i', self.bgzf.read(4))
+        self.references = []
+        for _ in range(n_ref):
+            l_name, = struct.unpack('<i', self.bgzf.read(4))
+            name = self.bgzf.read(l_name).rstrip('\0')
+            l_ref, = struct.unpack('<i', self.bgzf.read(4))
+            self.references.append((name, l_ref))
+        self.start = self.bgzf.tell()
+
+    def close(self):
+        self.bgzf.close()
+
+    def header(self):
+        """ Yield the lines of the SAM header, adding @SQ lines from the
+        binary reference list if the header text has none """
+        lines = [line + '\n' for line in self.text.split('\n') if line]
+        for line in lines:
+            yield line
+        if not any(line.startswith('@SQ') for line in lines):
+            for name, length in self.references:
+                yield '@SQ\tSN:%s\tLN:%d\n' % (name, length)
+
+    def _read_record(self):
+        """ Return (ref_id, pos, ref_end, sam_line) for the next alignment,
+        or None at the end of the file """
+        data = self.bgzf.read(4)
+        if len(data) < 4:
+            return None
+        block_size, = struct.unpack('<i', data)
+        body = self.bgzf.read(block_size)
+        (ref_id, pos, l_read_name, mapq, _, n_cigar_op, flag, l_seq,
+         next_ref_id, next_pos, tlen) = CORE_FORMAT.unpack_from(body)
+        i = CORE_FORMAT.size
+        qname = body[i:(i+l_read_name-1)]
+        i += l_read_name
+        cigar_ops = struct.unpack_from('<%dI' % n_cigar_op, body, i)
+        i += 4*n_cigar_op
+        packed = body[i:(i+(l_seq+1)//2)]
+        i += (l_seq+1)//2
+        qual = body[i:(i+l_seq)]
+
+        ref_span = 0
+        cigar = []
+        for op in cigar_ops:
+            length, operation = op >> 4, CIGAR_OPS[op & 0xF]
+            cigar.append('%d%s' % (length, operation))
+            if operation in REF_CONSUMING:
+                ref_span += length
+        seq = ''.join([SEQ_TABLE[ord(b)] for b in packed])[:l_seq]
+        if l_seq == 0 or qual[0] == '\xff':
+            qual = '*'
+        else:
+            qual = qual.translate(QUAL_TABLE)
+
+        if next_ref_id < 0:
+            rnext = '*'
+        elif next_ref_id == ref_id:
+            rnext = '='
+        else:
+            rnext = self.references[next_ref_id][0]
+        fields = [qname,
+                  str(flag),
+                  self.references[ref_id][0] if ref_id >= 0 else '*',
+                  str(pos+1),
+                  str(mapq),
+                  ''.join(cigar) or '*',
+                  rnext,
+                  str(next_pos+1),
+                  str(tlen),
+                  seq or '*',
+                  qual]
+        return ref_id, pos, pos + max(ref_span, 1), '\t'.join(fields) + '\n'
+
+    def __iter__(self):
+        """ Yield every alignment in the file as a line of SAM """
+        self.bgzf.seek(self.start)
+        while True:
+            record = self._read_record()
+            if record is None:
+                break
+            yield record[3]
+
+    def fetch(self, refname, beg, end, index, max_insert=None):
+        """
+        Yield alignments that overlap the zero-based interval [beg, end) of a
+        reference, as lines of SAM, with every alignment on that reference
+        that is paired with one of them, or whose pair spans the interval, so
+        that the pairs are the same as in a scan of the whole file.  The file
+        must be sorted by coordinate.
+        :param index: parsed BAM index from read_index()
+        :param max_insert: how far before beg to look for pairs that span the
+                           interval, or None to look from the start of the
+                           reference
+        """
+        ref_ids = [i for i, (name, _) in enumerate(self.references) if name == refname]
+        if not ref_ids:
+            return
+        ref_id = ref_ids[0]
+        span_beg = 0 if max_insert is None else max(0, beg - max_insert)
+        mate_starts = {}  # {qname: zero-based start of mate outside interval}
+        for _, _, ref_end, line in self._fetch_records(ref_id, span_beg, end, index):
+            qname, flag, _, _, _, _, rnext, pnext, _ = line.split('\t', 8)
+            flag = int(flag)
+            mate_start = int(pnext) - 1
+            if not (flag & 0x1 and not flag & 0x8 and rnext == '='):
+                mate_start = None
+            if ref_end <= beg and (mate_start is None or mate_start < end):
+                continue  # before the interval, and the pair does not span it
+            if mate_start is not None and not beg <= mate_start < end:
+                mate_starts[qname] = mate_start
+            yield line
+
+        # read the mates from runs of nearby start positions, skipping the
+        # alignments that overlap the interval, which were already yielded
+        for run_beg, run_end in group_starts(sorted(set(mate_starts.itervalues()))):
+            for _, pos, ref_end, line in self._fetch_records(ref_id, run_beg, run_end, index):
+                if pos < end and ref_end > beg:
+                    continue
+                if mate_starts.get(line.split('\t', 1)[0]) == pos:
+                    yield line
+
+    def _fetch_records(self, ref_id, beg, end, index):
+        """ Yield (ref_id, pos, ref_end, sam_line) for the alignments of a
+        reference that overlap the zero-based interval [beg, end) """
+        bins, intervals = index[ref_id]
+        min_offset = intervals[min(beg >> 14, len(intervals)-1)] if intervals else 0
+        chunks = sorted(chunk
+                        for bin_id in reg2bins(beg, end)
+                        for chunk in bins.get(bin_id, [])
+                        if chunk[1] > min_offset)
+        merged = []
+        for chunk_beg, chunk_end in chunks:
+            if merged and chunk_beg <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], chunk_end)
+            else:
+                merged.append([chunk_beg, chunk_end])
+
+        for chunk_beg, chunk_end in merged:
+            self.bgzf.seek(chunk_beg)
+            while self.bgzf.tell() < chunk_end:
+                record = self._read_record()
+                if record is None:
+                    break
+                record_ref_id, pos, ref_end, _ = record
+                if record_ref_id != ref_id or pos >= end:
+                    break
+                if ref_end > beg:
+                    yield record
+
+
+def group_starts(starts, max_gap=1 << 14):
+    """ Group sorted positions into [beg, end) intervals that contain them,
+    joining positions less than max_gap apart (by default the 16 kb windows
+    of the linear index), so that nearby mates are read in one pass """
+    runs = []
+    for start in starts:
+        if runs and start - runs[-1][1] < max_gap:
+            runs[-1][1] = start + 1
+        else:
+            runs.append([start, start + 1])
+    return runs
+
+
+def is_bam(path):
+    """ Check for the gzip magic number at the start of a file """
+    with open(path, 'rb') as handle:
+        return handle.read(2) == BGZF_MAGIC[:2]
+
+
+def find_index(path):
+    """ Return the path of the .bai index of a BAM file, or None """
+    for index_path in (path + '.bai', os.path.splitext(path)[0] + '.bai'):
+        if os.path.exists(index_path):
+            return index_path
+    return None
+
+
+def open_alignments(path, refname=None, left=None, right=None, threads=1, max_insert=None):
+    """
+    Iterate over the lines of a SAM file, or of a BAM file converted to SAM.
+    If a BAM file has an index and a reference name and interval are given,
+    only the header and the alignments of the pairs that overlap or span the
+    zero-based interval [left, right) are read, as by BamReader.fetch().  SAM files are always read in full.
+    :param path: path to SAM or BAM file, or '-' to read SAM from stdin
+    :param threads: number of threads used to decompress BAM blocks
+    :param max_insert: limit on the distance before left to look for pairs
+                       that span the interval, None for no limit
+    :return: an iterator over lines of SAM, including the header
+    """
+    if path == '-':
+        return iter(sys.stdin)
+    if not is_bam(path):
+        return iter(open(path, 'rU'))
+    return _iter_bam(path, refname, left, right, threads, max_insert)
+
+
+def _iter_bam(path, refname, left, right, threads, max_insert):
+    bam = BamReader(path, threads)
+    try:
+        for line in bam.header():
+            yield line
+        index_path = find_index(path)
+        if refname is None or left is None or right is None or index_path is None:
+            records = iter(bam)
+        else:
+            with open(index_path, 'rb') as handle:
+                index = read_index(handle)
+            records = bam.fetch(refname, left, right, index, max_insert)
+        for line in records:
+            yield line
+    finally:
+        bam.close()
@@ -0,0 +1,157 @@
+"""
+Banded pairwise alignment of nucleotide sequences with NumPy.
+
+The alignment is computed with affine gap penalties (Gotoh) and is global in
+the query but free of end gap penalties in the reference, so a query that
+covers part of the reference is aligned without penalty for the uncovered
+ends.  Only cells within a fixed distance of the main diagonal are computed,
+which suits a query that is already in the coordinates of the reference,
+such as a consensus of reads mapped to it.
+
+Each row of the band is computed with whole-array operations.  Diagonal
+and vertical moves depend only on the previous row.  Horizontal gaps depend
+on cells to their left in the same row, but the best gap into a cell opens
+at the maximum of (score + extend * column) over the cells to its left, so
+a whole row is resolved with one running maximum (np.maximum.accumulate).
+"""
+import numpy as np
+
+NEG_INF = -(1 << 28)
+CODES = np.full(256, 4, dtype=np.intp)  # anything but ACGT is ambiguous
+for i, base in enumerate('ACGT'):
+    CODES[ord(base)] = CODES[ord(base.lower())] = i
+
+def score_matrix(match=5, mismatch=-4, ambiguous=0):
+    """ Return a 5x5 substitution matrix for codes of A, C, G, T and N """
+    scores = np.full((5, 5), mismatch, dtype=np.int32)
+    np.fill_diagonal(scores, match)
+    scores[4, :] = ambiguous
+    scores[:, 4] = ambiguous
+    return scores
+
+
+def encode(seq):
+    """ Convert a nucleotide sequence into an array of codes 0-4 """
+    return CODES[np.frombuffer(seq, dtype=np.uint8)]
+
+
+def align(ref, query, band=100, scores=None, gap_open=10, gap_extend=1, gap_ambiguous=10):
+    """
+    Align a query sequence to a reference within a band around the diagonal.
+    :param ref: reference sequence
+    :param query: query sequence, in which gaps are treated as ambiguous
+    :param band: maximum distance of the alignment from the diagonal,
+                 widened if the query is longer than the reference by more
+    :param scores: substitution matrix from score_matrix()
+    :param gap_open: penalty for the first position of a gap
+    :param gap_extend: penalty for each further position of a gap
+    :param gap_ambiguous: further penalty for each ambiguous query position in
+                          a gap of the reference, so that ambiguous positions
+                          are aligned to reference bases where possible
+    :return: (aligned reference, aligned query, score)
+    """
+    if scores is None:
+        scores = score_matrix()
+    n, m = len(ref), len(query)
+    if m == 0:
+        return ref, '-' * n, 0
+    band = max(band, m - n)  # the query must fit alongside the reference
+    width = 2*band + 1
+    # substitution scores of each query code against the reference, padded
+    # so that row i of the band is the slice [i-1, i-1+width)
+    profile = np.full((5, max(n, m) + 2*band), NEG_INF, dtype=np.int32)
+    profile[:, band:(band+n)] = scores[:, encode(ref)]
+    qcodes = encode(query)
+    ambiguous = (qcodes == 4).tolist()
+
+    # row 0: any number of leading reference positions can be skipped freely
+    M = np.full(width, NEG_INF, dtype=np.int32)
+    M[band:(band+min(n, band)+1)] = 0
+    X = np.full(width, NEG_INF, dtype=np.int32)
+    Y = np.full(width, NEG_INF, dtype=np.int32)
+
+    # traceback: match state entered from vertical (from_x) or horizontal
+    # (from_y) gap state, gaps extended rather than opened, and cells where
+    # the vertical gap state beats the match state (x_best)
+    from_x = np.zeros((m+1, width), dtype=bool)
+    from_y = np.zeros((m+1, width), dtype=bool)
+    x_extend = np.zeros((m+1, width), dtype=bool)
+    y_extend = np.zeros((m+1, width), dtype=bool)
+    x_best = np.zeros((m+1, width), dtype=bool)
+
+    ramp = gap_extend * np.arange(width, dtype=np.int32)
+    best = np.empty(width, dtype=np.int32)
+    up_open = np.empty(width, dtype=np.int32)
+    up_extend = np.empty(width, dtype=np.int32)
+    A = np.empty(width, dtype=np.int32)
+    run = np.empty(width, dtype=np.int32)
+    up_open[-1] = up_extend[-1] = NEG_INF
+    for i in range(1, m+1):
+        # diagonal move from (i-1, j-1), at the same offset in the previous row
+        np.maximum(M, X, out=best)
+        np.maximum(best, Y, out=best)
+        np.logical_and(X > M, X >= Y, out=from_x[i])
+        np.logical_and(Y > M, Y > X, out=from_y[i])
+        newM = best + profile[qcodes[i-1], (i-1):(i-1+width)]
+        np.maximum(newM, NEG_INF, out=newM)
+
+        # vertical move from (i-1, j), at the next offset in the previous row
+        np.subtract(M[1:], gap_open, out=up_open[:-1])
+        np.subtract(X[1:], gap_extend, out=up_extend[:-1])
+        np.greater(up_extend, up_open, out=x_extend[i])
+        newX = np.maximum(up_open, up_extend)
+        if ambiguous[i-1]:
+            newX -= gap_ambiguous
+        np.maximum(newX, NEG_INF, out=newX)
+
+        # horizontal move from (i, j-1), resolved with a running maximum
+        np.maximum(newM, newX, out=A)
+        np.greater(newX, newM, out=x_best[i])
+        np.add(A, ramp, out=run)
+        np.maximum.accumulate(run, out=run)
+        newY = np.empty(width, dtype=np.int32)
+        newY[0] = NEG_INF
+        np.subtract(run[:-1], ramp[1:], out=newY[1:])
+        newY[1:] += gap_extend - gap_open
+        last = n - i + band  # columns beyond the end of the reference
+        if last < width - 1:
+            newY[(last+1):] = NEG_INF
+        np.maximum(newY, NEG_INF, out=newY)
+        np.greater(newY[:-1] - gap_extend, A[:-1] - gap_open, out=y_extend[i, 1:])
+
+        M, X, Y = newM, newX, newY
+
+    # any number of trailing reference positions can be skipped freely
+    final = np.maximum(M, np.maximum(X, Y))
+    t = int(np.argmax(final))
+    score = int(final[t])
+    state = 'M' if M[t] == score else ('X' if X[t] == score else 'Y')
+    i = m
+    end = i + t - band
+
+    # trace back from (m, end) to row 0
+    aref, aquery = [], []
+    while i > 0:
+        j = i + t - band
+        if state == 'M':
+            aref.append(ref[j-1])
+            aquery.append(query[i-1])
+            state = 'X' if from_x[i, t] else ('Y' if from_y[i, t] else 'M')
+            i -= 1
+        elif state == 'X':
+            aref.append('-')
+            aquery.append(query[i-1])
+            state = 'X' if x_extend[i, t] else 'M'
+            i -= 1
+            t += 1
+        else:
+            aref.append(ref[j-1])
+            aquery.append('-')
+            if not y_extend[i, t]:
+                state = 'X' if x_best[i, t-1] else 'M'
+            t -= 1
+    start = t - band
+
+    aref = ref[:start] + ''.join(reversed(aref)) + ref[end:]
+    aquery = '-'*start + ''.join(reversed(aquery)) + '-'*(n-end)
+    return aref, aquery, score
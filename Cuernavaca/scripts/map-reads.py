@@ -0,0 +1,599 @@
+"""
+Map paired-end reads in FASTQ files to one or more reference sequences and
+write the alignments as SAM, for adapt-ref.py and slice-sam.py.
+
+Reads are seeded by exact matches of k-mers to an index of the references,
+and the best diagonal (reference position minus read position) by number of
+seed hits is extended by comparing the read to the reference without gaps.
+If there are too many mismatches, the read is aligned to the reference
+around the diagonal with the banded aligner used by adapt-ref.py.  Reads
+whose alignment still has too many differences, as when a few seeds hit the
+reference by chance, are written as unmapped.
+
+The index of each reference is cached on disk under a digest of its name and
+sequence, so that only references that have changed since the last run (for
+example, by adapt-ref.py) are indexed again.  The index of a changed
+reference is updated from that of its last version, by re-indexing only the
+k-mers that overlap the changed bases.
+"""
+import os
+import re
+import sys
+import gzip
+import string
+import hashlib
+import argparse
+import tempfile
+import itertools
+import multiprocessing
+from collections import deque
+
+import numpy as np
+
+import banded_align
+
+tempdir = tempfile.gettempdir()
+if not os.access(tempdir, os.W_OK):
+    # user does not have permission to write to temporary directory
+    tempdir = os.getcwd()
+
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for i, base in enumerate('ACGT'):
+    BASE_CODES[ord(base)] = BASE_CODES[ord(base.lower())] = i
+COMPLEMENT = string.maketrans('ACGTNacgtn', 'TGCANtgcan')
+INDEX_VERSION = 1  # change when the format of cached indexes changes
+
+index = None  # KmerIndex of a worker process, see init_worker()
+
+
+def convert_fasta (handle):
+    result = []
+    h = None
+    sequence = ''
+    for line in handle:
+        if line.startswith('$'):
+            continue
+        elif line.startswith('>') or line.startswith('#'):
+            if len(sequence) > 0:
+                result.append([h, sequence])
+                sequence = ''
+            h = line.strip('>#\n')
+        else:
+            sequence += line.strip('\n')
+    result.append([h,sequence])
+    return result
+
+
+def iter_fastq(handle):
+    """ Yield (name, sequence, quality) for each record of a FASTQ file """
+    for header, seq, _, qual in itertools.izip(*[handle]*4):
+        name = header[1:].split()[0]
+        if name.endswith('/1') or name.endswith('/2'):
+            name = name[:-2]
+        yield name, seq.rstrip('\n'), qual.rstrip('\n')
+
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def kmer_codes(seq, k):
+    """
+    Pack each k-mer of a sequence into an integer with 2 bits per base.
+    :return: (codes, valid) arrays, one entry per start position, where
+             valid is False for k-mers that contain a base other than ACGT
+    """
+    n = len(seq) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+    bases = BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+    codes = np.zeros(n, dtype=np.uint64)
+    invalid = np.zeros(n, dtype=bool)
+    for i in range(k):
+        window = bases[i:(i+n)]
+        codes = (codes << np.uint64(2)) | (window & 3).astype(np.uint64)
+        invalid |= window > 3
+    return codes, ~invalid
+
+
+class KmerIndex(object):
+    """
+    Positions of the k-mers of a set of reference sequences.
+
+    Attributes:
+        k: length of k-mers
+        refnames, refseqs: names and sequences of the references
+        keys: sorted array of k-mer codes from kmer_codes()
+        refs, positions: reference number and zero-based position of each key
+    """
+    def __init__(self, k, refnames, refseqs, parts):
+        """
+        :param parts: list of (keys, positions) arrays for each reference,
+                      from index_reference()
+        """
+        self.k = k
+        self.refnames = refnames
+        self.refseqs = refseqs
+        keys = np.concatenate([part_keys for part_keys, _ in parts])
+        order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[order]
+        self.refs = np.concatenate([np.full(len(part_keys), i, dtype=np.int32)
+                                    for i, (part_keys, _) in enumerate(parts)])[order]
+        self.positions = np.concatenate([part_positions
+                                         for _, part_positions in parts])[order]
+
+
+def index_reference(seq, k):
+    """ Return sorted k-mer codes of a reference and their positions """
+    codes, valid = kmer_codes(seq, k)
+    positions = np.flatnonzero(valid).astype(np.int32)
+    codes = codes[positions]
+    order = np.argsort(codes, kind='mergesort')
+    return codes[order], positions[order]
+
+
+def first_mismatch(a, b, i, j):
+    """ Return the length of the common prefix of a[i:] and b[j:], for arrays
+    of bytes, comparing chunks of growing size """
+    n = min(len(a) - i, len(b) - j)
+    offset, step = 0, 1024
+    while offset < n:
+        size = min(step, n - offset)
+        diff = np.flatnonzero(a[(i+offset):(i+offset+size)] != b[(j+offset):(j+offset+size)])
+        if len(diff):
+            return offset + int(diff[0])
+        offset += size
+        step *= 2
+    return n
+
+
+def diff_sequences(old, new, max_shift=100, anchor=20):
+    """
+    Find the blocks that differ between two versions of a sequence.  After
+    each mismatch, the sequences are matched again at the smallest shift
+    (up to max_shift in either sequence) that is followed by anchor equal
+    bases, and whatever cannot be matched again is one block to the end.
+    :return: list of (old start, old end, new start, new end) of each block,
+             in order, where every base outside the blocks is unchanged
+    """
+    a = np.frombuffer(old, dtype=np.uint8)
+    b = np.frombuffer(new, dtype=np.uint8)
+    blocks = []
+    i = j = 0
+    while True:
+        n = first_mismatch(a, b, i, j)
+        i += n
+        j += n
+        if i == len(old) and j == len(new):
+            return blocks
+        shift = None
+        for d in range(1, max_shift + 1):
+            # substitutions first, then gaps in either sequence
+            for di, dj in [(d, d)] + [(d, e) for e in range(d)] + [(e, d) for e in range(d)]:
+                if i + di <= len(old) and j + dj <= len(new) and \
+                        old[(i+di):(i+di+anchor)] == new[(j+dj):(j+dj+anchor)]:
+                    shift = di, dj
+                    break
+            if shift is not None:
+                break
+        if shift is None:
+            blocks.append((i, len(old), j, len(new)))
+            return blocks
+        blocks.append((i, i + shift[0], j, j + shift[1]))
+        i += shift[0]
+        j += shift[1]
+
+
+def update_index(keys, positions, old, new, k, max_changed=0.25):
+    """
+    Update the index of a reference from index_reference() after its
+    sequence has changed, re-indexing only the k-mers that overlap a changed
+    block and shifting the positions of the others.
+    :param keys, positions: index of the old sequence
+    :param max_changed: proportion of k-mers that can change before it is
+                        quicker to index the new sequence from scratch
+    :return: (keys, positions) as index_reference(new, k) would return, or
+             None if too much of the sequence changed
+    """
+    blocks = diff_sequences(old, new)
+    if not blocks:
+        return keys, positions
+    old_starts, old_ends, new_starts, new_ends = [np.array(column, dtype=np.int64)
+                                                  for column in zip(*blocks)]
+
+    # old k-mers starting in (old start - k, old end) overlap a block
+    drop = np.zeros(len(old) + 1, dtype=np.int32)
+    np.add.at(drop, np.maximum(old_starts - k + 1, 0), 1)
+    np.add.at(drop, old_ends, -1)
+    dropped = np.cumsum(drop)[positions] > 0
+    keep = ~dropped
+    # positions after a block shift by the change in its length
+    shifts = np.concatenate([[0], np.cumsum((new_ends - new_starts) - (old_ends - old_starts))])
+    kept_positions = positions[keep].astype(np.int64)
+    kept_positions += shifts[np.searchsorted(old_ends, kept_positions, 'right')]
+    kept_keys = keys[keep]
+
+    # new k-mers starting in (new start - k, new end)
+    windows = []
+    for start, end in zip(np.maximum(new_starts - k + 1, 0), np.minimum(new_ends, len(new) - k + 1)):
+        if windows and start <= windows[-1][1]:
+            windows[-1][1] = max(windows[-1][1], end)
+        elif start < end:
+            windows.append([start, end])
+    if sum(end - start for start, end in windows) > max_changed * max(len(new) - k + 1, 1):
+        return None
+    added_keys, added_positions = [], []
+    for start, end in windows:
+        codes, valid = kmer_codes(new[start:(end+k-1)], k)
+        added_keys.append(codes[valid])
+        added_positions.append(np.flatnonzero(valid) + start)
+    added_keys = np.concatenate(added_keys or [np.zeros(0, dtype=np.uint64)])
+    added_positions = np.concatenate(added_positions or [np.zeros(0, dtype=np.int64)])
+    order = np.lexsort((added_positions, added_keys))
+    added_keys, added_positions = added_keys[order], added_positions[order]
+
+    # insert new k-mers after kept k-mers with lower keys, or equal keys at
+    # lower positions, as the stable sort in index_reference() orders them
+    lo = np.searchsorted(kept_keys, added_keys, 'left')
+    hi = np.searchsorted(kept_keys, added_keys, 'right')
+    where = lo.copy()
+    for i in np.flatnonzero(hi > lo):
+        where[i] += np.searchsorted(kept_positions[lo[i]:hi[i]], added_positions[i])
+    return (np.insert(kept_keys, where, added_keys),
+            np.insert(kept_positions, where, added_positions).astype(np.int32))
+
+
+def save_entry(cachedir, entry, **arrays):
+    """ Write arrays to a cache entry through a temporary file, so that an
+    interrupted write does not leave a broken entry """
+    fd, tmpfile = tempfile.mkstemp(dir=cachedir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as handle:
+        np.savez(handle, **arrays)
+    os.rename(tmpfile, entry)
+
+
+def load_index(refs, k, cachedir=None):
+    """
+    Build a KmerIndex, using the indexes of references that are cached in
+    cachedir, and indexing (and caching) the rest.  A reference that has
+    changed since it was last indexed under the same name is updated from
+    the cached index of its previous sequence by update_index().
+    :param refs: list of (refname, sequence)
+    :param cachedir: directory of cached reference indexes, or None
+    :return: (KmerIndex, number of references that were indexed from
+              scratch, number of references that were updated)
+    """
+    if cachedir and not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    parts = []
+    nindexed = nupdated = 0
+    for refname, seq in refs:
+        entry = latest = None
+        if cachedir:
+            digest = hashlib.sha1('%d\t%d\t%s\t%s' % (INDEX_VERSION, k, refname, seq))
+            entry = os.path.join(cachedir, digest.hexdigest() + '.npz')
+            # the last sequence indexed under this name
+            latest = os.path.join(cachedir, hashlib.sha1(
+                '%d\t%d\t%s' % (INDEX_VERSION, k, refname)).hexdigest() + '.latest.npz')
+            if os.path.exists(entry):
+                os.utime(entry, None)
+                with np.load(entry) as arrays:
+                    parts.append((arrays['keys'], arrays['positions']))
+                continue
+
+        part = None
+        if latest and os.path.exists(latest):
+            with np.load(latest) as arrays:
+                part = update_index(arrays['keys'], arrays['positions'],
+                                    arrays['seq'].tostring(), seq, k)
+        if part is None:
+            part = index_reference(seq, k)
+            nindexed += 1
+        else:
+            nupdated += 1
+        keys, positions = part
+        parts.append((keys, positions))
+        if entry:
+            save_entry(cachedir, entry, keys=keys, positions=positions)
+            save_entry(cachedir, latest, keys=keys, positions=positions,
+                       seq=np.frombuffer(seq, dtype=np.uint8))
+
+    refnames = [refname for refname, _ in refs]
+    refseqs = [seq for _, seq in refs]
+    return KmerIndex(k, refnames, refseqs, parts), nindexed, nupdated
+
+
+def find_diagonals(index, seq, max_hits, band):
+    """
+    Count seed hits of a read on each diagonal of each reference.
+    :param max_hits: k-mers with more hits than this are ignored as repeats
+    :param band: distance from a diagonal within which other hits suggest
+                 an insertion or deletion
+    :return: list of up to two (hits, refnum, diagonal, nearby hits), best
+             first, where nearby hits is the number of hits on other
+             diagonals within band of this one
+    """
+    codes, valid = kmer_codes(seq, index.k)
+    qpos = np.flatnonzero(valid)
+    codes = codes[qpos]
+    lo = np.searchsorted(index.keys, codes, 'left')
+    hi = np.searchsorted(index.keys, codes, 'right')
+    nhits = hi - lo
+    keep = (nhits > 0) & (nhits <= max_hits)
+    lo, nhits, qpos = lo[keep], nhits[keep], qpos[keep]
+    if len(lo) == 0:
+        return []
+
+    # expand ranges of hits into one entry per hit
+    first = np.repeat(np.cumsum(nhits) - nhits, nhits)
+    hits = np.repeat(lo, nhits) + np.arange(nhits.sum()) - first
+    refs = index.refs[hits].astype(np.int64)
+    diagonals = index.positions[hits].astype(np.int64) - np.repeat(qpos, nhits)
+    keys, counts = np.unique(refs << 32 | (diagonals + (1 << 31)), return_counts=True)
+    result = []
+    for i in np.argsort(-counts, kind='mergesort')[:2]:
+        refnum, diagonal = int(keys[i] >> 32), int((keys[i] & 0xFFFFFFFF) - (1 << 31))
+        distance = np.abs(diagonals - diagonal)
+        nearby = int(((refs == refnum) & (distance > 0) & (distance <= band)).sum())
+        result.append((int(counts[i]), refnum, diagonal, nearby))
+    return result
+
+
+def make_cigar(ops):
+    """ Run-length encode a string of CIGAR operations """
+    return ''.join('%d%s' % (len(list(group)), op) for op, group in itertools.groupby(ops))
+
+
+def extend(index, refnum, diagonal, seq, band, max_mismatch, max_diff, nearby=0):
+    """
+    Align a read to a reference around a diagonal.  An ungapped alignment is
+    used if there are few mismatches, or if no seeds suggest an insertion or
+    deletion and there are at most max_diff differences.  Otherwise the read
+    is aligned with gaps, where each inserted, deleted and soft clipped base
+    counts as one difference.
+    :param max_mismatch: proportion of mismatches accepted without trying a
+                         gapped alignment
+    :param max_diff: proportion of differences above which an alignment is
+                     rejected, for seeds that hit the reference by chance
+    :param nearby: number of seed hits on diagonals within band of this one
+    :return: (zero-based position, CIGAR string, number of differences), or
+             None if the read is not aligned with at most max_diff
+             differences
+    """
+    refseq = index.refseqs[refnum]
+    limit = max_diff * len(seq)
+    if diagonal >= 0 and diagonal + len(seq) <= len(refseq):
+        # try an ungapped alignment first
+        rbases = BASE_CODES[np.frombuffer(refseq[diagonal:(diagonal+len(seq))], dtype=np.uint8)]
+        qbases = BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+        mismatches = int(((rbases != qbases) & (rbases < 4) & (qbases < 4)).sum())
+        if mismatches <= max_mismatch * len(seq) or (nearby == 0 and mismatches <= limit):
+            return diagonal, '%dM' % len(seq), mismatches
+
+    left = max(0, diagonal - band)
+    right = min(len(refseq), diagonal + len(seq) + band)
+    aref, aquery, _ = banded_align.align(refseq[left:right].upper(), seq.upper(), 2*band)
+    start = len(aquery) - len(aquery.lstrip('-'))
+    end = len(aquery.rstrip('-'))
+    pos = left + start
+    ops = []
+    mismatches = 0
+    for r, q in zip(aref[start:end], aquery[start:end]):
+        if r == '-':
+            ops.append('I')
+        elif q == '-':
+            ops.append('D')
+        else:
+            ops.append('M')
+            mismatches += r != q and r != 'N' and q != 'N'
+
+    # the parsers expect each end of the alignment to be a match interval,
+    # so soft clip insertions at the ends of the read
+    clips = [0, 0]
+    while ops and ops[0] != 'M':
+        if ops.pop(0) == 'I':
+            clips[0] += 1
+        else:
+            pos += 1
+    while ops and ops[-1] != 'M':
+        if ops.pop() == 'I':
+            clips[1] += 1
+    if not ops:
+        return None
+    ndiff = mismatches + sum(clips) + sum(op != 'M' for op in ops)
+    if ndiff > limit:
+        return None
+    return pos, make_cigar('S'*clips[0] + ''.join(ops) + 'S'*clips[1]), ndiff
+
+
+def map_read(index, seq, band, max_hits, min_seeds, max_mismatch, max_diff):
+    """
+    Map one read to the best diagonal of either strand.
+    :return: None if the read is not mapped, or a dict with the reference
+             number, zero-based position, CIGAR, whether the read is reverse
+             complemented and the mapping quality
+    """
+    best = []
+    for is_reverse, strand in ((False, seq), (True, reverse_complement(seq))):
+        best.extend((hits, is_reverse, refnum, diagonal, nearby)
+                    for hits, refnum, diagonal, nearby in find_diagonals(index, strand, max_hits, band))
+    best.sort(reverse=True)
+    if not best or best[0][0] < min_seeds:
+        return None
+    hits, is_reverse, refnum, diagonal, nearby = best[0]
+    runner_up = best[1][0] if len(best) > 1 else 0
+    strand = reverse_complement(seq) if is_reverse else seq
+    alignment = extend(index, refnum, diagonal, strand, band, max_mismatch, max_diff, nearby)
+    if alignment is None:
+        return None
+    pos, cigar, _ = alignment
+    return {'refnum': refnum, 'pos': pos, 'cigar': cigar, 'is_reverse': is_reverse,
+            'mapq': 60 * (hits - runner_up) // hits}
+
+
+def ref_end(hit):
+    """ Return the zero-based position after the last aligned base of a hit """
+    length = 0
+    for count, op in re.findall('([0-9]+)([MIDNSHPX=])', hit['cigar']):
+        if op in 'MD':
+            length += int(count)
+    return hit['pos'] + length
+
+
+def sam_pair(index, qname, reads, hits):
+    """
+    Format a pair of mapped (or unmapped) reads as two lines of SAM.
+    :param reads: [(seq, qual), (seq, qual)] for the first and second reads
+    :param hits: results of map_read() for each read
+    """
+    rows = []
+    for i, ((seq, qual), hit) in enumerate(zip(reads, hits)):
+        mate = hits[1-i]
+        flag = 0x1 | (0x40 if i == 0 else 0x80)
+        if hit is None:
+            flag |= 0x4
+            rname, pos, mapq, cigar = '*', 0, 0, '*'
+        else:
+            rname, pos, mapq, cigar = index.refnames[hit['refnum']], hit['pos']+1, hit['mapq'], hit['cigar']
+            if hit['is_reverse']:
+                flag |= 0x10
+                seq, qual = reverse_complement(seq), qual[::-1]
+        if mate is None:
+            flag |= 0x8
+            rnext, pnext = '*', 0
+        else:
+            if mate['is_reverse']:
+                flag |= 0x20
+            rnext = index.refnames[mate['refnum']]
+            pnext = mate['pos']+1
+        tlen = 0
+        if hit is not None and mate is not None and hit['refnum'] == mate['refnum']:
+            flag |= 0x2
+            rnext = '='
+            left = min(hit['pos'], mate['pos'])
+            right = max(ref_end(hit), ref_end(mate))
+            is_left = (hit['pos'], i) < (mate['pos'], 1-i)
+            tlen = (right - left) if is_left else (left - right)
+        rows.append('\t'.join(map(str, [qname, flag, rname, pos, mapq, cigar,
+                                         rnext, pnext, tlen, seq, qual])) + '\n')
+    return rows
+
+
+def init_worker(kmer_index):
+    """ Share the k-mer index with a worker process """
+    global index
+    index = kmer_index
+
+
+def map_batch(job):
+    """
+    Map a batch of read pairs with the index of this process.
+    :param job: (pairs, band, max_hits, min_seeds, max_mismatch, max_diff),
+                where each pair is (qname, (seq1, qual1), (seq2, qual2))
+    :return: list of lines of SAM
+    """
+    pairs, band, max_hits, min_seeds, max_mismatch, max_diff = job
+    rows = []
+    for qname, read1, read2 in pairs:
+        hits = [map_read(index, seq, band, max_hits, min_seeds, max_mismatch, max_diff)
+                for seq, _ in (read1, read2)]
+        rows.extend(sam_pair(index, qname, [read1, read2], hits))
+    return rows
+
+
+def open_fastq(path):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rU')
+
+
+def parallel_map(jobs, kmer_index, threads):
+    """
+    Apply map_batch() to jobs in a pool of worker processes.  Results are
+    yielded in the same order as the jobs, and at most two jobs per process
+    are in flight at any time, so that the FASTQ files are read no faster
+    than the reads are mapped.
+    """
+    pool = multiprocessing.Pool(threads, init_worker, (kmer_index,))
+    pending = deque()
+    try:
+        for job in jobs:
+            pending.append(pool.apply_async(map_batch, (job,)))
+            if len(pending) >= 2*threads:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Map paired-end reads to reference sequences by seeding with '
+                    'k-mers and extending, and write SAM.'
+    )
+    parser.add_argument('ref', type=argparse.FileType('rU'),
+                        help='<input> FASTA file containing references')
+    parser.add_argument('fastq1', help='<input> FASTQ file of first reads, can be gzipped')
+    parser.add_argument('fastq2', help='<input> FASTQ file of second reads, can be gzipped')
+    parser.add_argument('out', type=argparse.FileType('w'),
+                        help='<output> SAM file')
+    parser.add_argument('-k', type=int, default=11,
+                        help='<option> Length of k-mer seeds, at most 32')
+    parser.add_argument('-band', type=int, default=10,
+                        help='<option> Band width for gapped extension')
+    parser.add_argument('-max_hits', type=int, default=50,
+                        help='<option> Ignore k-mers with more hits in the references')
+    parser.add_argument('-min_seeds', type=int, default=2,
+                        help='<option> Minimum number of seed hits to map a read')
+    parser.add_argument('-max_mismatch', type=float, default=0.05,
+                        help='<option> Maximum proportion of mismatches in an ungapped '
+                             'extension, before trying a gapped alignment')
+    parser.add_argument('-max_diff', type=float, default=0.3,
+                        help='<option> Maximum proportion of differences in any extension, '
+                             'counting each inserted, deleted and soft clipped base as one.  '
+                             'Reads with more are written as unmapped.')
+    parser.add_argument('-threads', type=int, default=1,
+                        help='<option> Number of processes used to map reads')
+    parser.add_argument('-batch_size', type=int, default=500,
+                        help='<option> Number of read pairs sent to a process at a time')
+    parser.add_argument('-cache_dir', default=os.path.join(tempdir, 'map-reads-cache'),
+                        help='<option> Directory for caching the index of each reference')
+    parser.add_argument('-no_cache', action='store_true',
+                        help='<option> Do not read or write cached indexes')
+    args = parser.parse_args()
+
+    if not 0 < args.k <= 32:
+        print 'ERROR: k must be between 1 and 32'
+        sys.exit()
+
+    refs = [(h.split()[0], s.replace('-', '').upper()) for h, s in convert_fasta(args.ref)]
+    kmer_index, nindexed, nupdated = load_index(refs, args.k,
+                                                None if args.no_cache else args.cache_dir)
+    sys.stderr.write('Indexed %d and updated %d of %d references\n' % (nindexed, nupdated, len(refs)))
+
+    args.out.write('@HD\tVN:1.0\tSO:unsorted\n')
+    for refname, seq in refs:
+        args.out.write('@SQ\tSN:%s\tLN:%d\n' % (refname, len(seq)))
+    args.out.write('@PG\tID:map-reads\tPN:map-reads.py\n')
+
+    pairs = ((name1, (seq1, qual1), (seq2, qual2))
+             for (name1, seq1, qual1), (name2, seq2, qual2)
+             in itertools.izip(iter_fastq(open_fastq(args.fastq1)),
+                               iter_fastq(open_fastq(args.fastq2))))
+    jobs = iter(lambda: (list(itertools.islice(pairs, args.batch_size)), args.band,
+                         args.max_hits, args.min_seeds, args.max_mismatch, args.max_diff), None)
+    jobs = itertools.takewhile(lambda job: job[0], jobs)
+
+    if args.threads > 1:
+        results = parallel_map(jobs, kmer_index, args.threads)
+    else:
+        init_worker(kmer_index)
+        results = itertools.imap(map_batch, jobs)
+    for rows in results:
+        args.out.writelines(rows)
+    args.out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,21 +6,36 @@ import argparse
 from csv import DictWriter
 
 from struct import unpack
-import csv
 import os
 from operator import itemgetter
-import math
-from itertools import groupby
+import stat
+import time
+import itertools
 
+from xml.etree import ElementTree
 
-def read_records(data_file, min_version):
-    """ Read records from an Illumina Interop file.
-    :param file data_file: an open file-like object. Needs to have a two-byte
-    header with the file version and the length of each record, followed by the
-    records.
+import numpy as np
+
+
+ERROR_DTYPE = np.dtype([('lane', '<u2'),
+                        ('tile', '<u2'),
+                        ('cycle', '<u2'),
+                        ('error_rate', '<f4'),
+                        ('num_0_errors', '<u4'),
+                        ('num_1_error', '<u4'),
+                        ('num_2_errors', '<u4'),
+                        ('num_3_errors', '<u4'),
+                        ('num_4_errors', '<u4')])
+
+# read lengths of a run without a RunInfo.xml file: forward, indexes, reverse
+DEFAULT_READ_LENGTHS = [300, 8, 8, 300]
+
+
+def read_header(data_file, min_version):
+    """ Read the header of an Illumina Interop file.
+    :param file data_file: an open file-like object, at the start of the file
     :param int min_version: the minimum accepted file version.
-    :return: an iterator over the records in the file. Each record will be a raw
-    byte string of the length from the header.
+    :return: (version, record_length)
     """
     header = data_file.read(2)
     version, record_length = unpack('!BB', header)
@@ -30,6 +45,19 @@ def read_records(data_file, min_version):
                 version,
                 min_version,
                 data_file.name))
+    return version, record_length
+
+
+def read_records(data_file, min_version):
+    """ Read records from an Illumina Interop file.
+    :param file data_file: an open file-like object. Needs to have a two-byte
+    header with the file version and the length of each record, followed by the
+    records.
+    :param int min_version: the minimum accepted file version.
+    :return: an iterator over the records in the file. Each record will be a raw
+    byte string of the length from the header.
+    """
+    _version, record_length = read_header(data_file, min_version)
     while True:
         data = data_file.read(record_length)
         read_length = len(data)
@@ -42,6 +70,406 @@ def read_records(data_file, min_version):
         yield data
 
 
+def _record_dtype(data_file, dtype, record_length):
+    """ Pad a structured dtype to the record length from the header """
+    if record_length < dtype.itemsize:
+        raise IOError('Record length {} is less than {} in {}.'.format(
+            record_length,
+            dtype.itemsize,
+            data_file.name))
+    return np.dtype(dict(names=dtype.names,
+                         formats=[dtype.fields[name][0] for name in dtype.names],
+                         offsets=[dtype.fields[name][1] for name in dtype.names],
+                         itemsize=record_length))
+
+
+def read_body(data_file, dtype, record_length):
+    """ Read the records that follow the header of an Illumina Interop file
+    into a structured array.
+
+    A regular file is memory-mapped, so records are only read from disk as
+    the array is used.  Other file-like objects are read into memory.
+    :param file data_file: an open file-like object, positioned after the header
+    :param dtype: a structured dtype for the leading fields of each record,
+    which may be shorter than the record length.
+    :param int record_length: the record length from the header.
+    :return: a structured array with one element per record
+    """
+    record_dtype = _record_dtype(data_file, dtype, record_length)
+    try:
+        info = os.fstat(data_file.fileno())
+        is_regular = stat.S_ISREG(info.st_mode)
+    except (AttributeError, IOError, ValueError):
+        is_regular = False
+
+    offset = data_file.tell() if is_regular else 0
+    if is_regular:
+        body_length = info.st_size - offset
+    else:
+        body = data_file.read()
+        body_length = len(body)
+    partial_length = body_length % record_length
+    if partial_length:
+        raise IOError('Partial record of length {} found in {}.'.format(
+            partial_length,
+            data_file.name))
+    count = body_length // record_length
+    if count == 0:
+        return np.zeros(0, record_dtype)
+    if is_regular:
+        return np.memmap(data_file, record_dtype, 'r', offset, (count,))
+    return np.frombuffer(body, record_dtype, count)
+
+
+def read_array(data_file, dtype, min_version):
+    """ Read all records from an Illumina Interop file into a structured array.
+    :param file data_file: an open file-like object, as for read_records()
+    :param dtype: a structured dtype for the leading fields of each record.
+    :param int min_version: the minimum accepted file version.
+    :return: a structured array with one element per record, as from
+    read_body()
+    """
+    _version, record_length = read_header(data_file, min_version)
+    return read_body(data_file, dtype, record_length)
+
+
+def read_qscore_bins(data_file):
+    """ Read the quality score binning from the header of a QMetricsOut.bin
+    file of version 5 or later.
+    :return: a dictionary of arrays with the lower and upper limits and the
+    remapped score of each bin, or None if scores were not binned.
+    """
+    if not ord(data_file.read(1)):
+        return None
+    bin_count = ord(data_file.read(1))
+    limits = np.frombuffer(data_file.read(3 * bin_count), np.uint8)
+    return dict(lower=limits[:bin_count],
+                upper=limits[bin_count:(2 * bin_count)],
+                value=limits[(2 * bin_count):])
+
+
+class InteropFormat(object):
+    """ Declared layout of the records in one version of an InterOp file.
+
+    Each field is (name, format) or (name, format, count).  A count of None
+    takes up the rest of the record, for histograms whose length depends on
+    the header.
+    """
+    def __init__(self, fields, read_extra=None):
+        """
+        :param fields: list of field declarations
+        :param read_extra: function that reads any header values that follow
+        the version and record length from the open file, or None.
+        """
+        self.fields = fields
+        self.read_extra = read_extra
+
+    def dtype(self, record_length):
+        """ Build the structured dtype of records with a given length """
+        fixed = [field for field in self.fields if len(field) == 2 or field[2] is not None]
+        fixed_length = np.dtype(fixed).itemsize
+        fields = []
+        for field in self.fields:
+            if len(field) > 2 and field[2] is None:
+                count = (record_length - fixed_length) // np.dtype(field[1]).itemsize
+                field = (field[0], field[1], max(count, 1))
+            fields.append(field)
+        return np.dtype(fields)
+
+
+TILE_FIELDS = [('lane', '<u2'),
+               ('tile', '<u2'),
+               ('metric_code', '<u2'),
+               ('metric_value', '<f4')]
+Q_FIELDS = [('lane', '<u2'),
+            ('tile', '<u2'),
+            ('cycle', '<u2'),
+            ('histogram', '<u4', None)]
+EXTRACTION_FIELDS = [('lane', '<u2'),
+                     ('tile', '<u2'),
+                     ('cycle', '<u2'),
+                     ('fwhm', '<f4', 4),
+                     ('intensity', '<u2', 4),
+                     ('date_time', '<u8')]
+
+# {file name: {version: InteropFormat}}
+INTEROP_FORMATS = {
+    'ErrorMetricsOut.bin': {3: InteropFormat(ERROR_DTYPE.descr)},
+    'TileMetricsOut.bin': {2: InteropFormat(TILE_FIELDS)},
+    'QMetricsOut.bin': {4: InteropFormat(Q_FIELDS),
+                        5: InteropFormat(Q_FIELDS, read_qscore_bins),
+                        6: InteropFormat(Q_FIELDS, read_qscore_bins)},
+    'ExtractionMetricsOut.bin': {2: InteropFormat(EXTRACTION_FIELDS)}
+}
+
+
+class InteropMetrics(object):
+    """ The records of an InterOp file as a structured array, with the values
+    from its header.  Fields are columns of the array, so metrics['cycle'] is
+    an array of the cycle of every record.
+    """
+    def __init__(self, name, version, records, extra=None):
+        self.name = name
+        self.version = version
+        self.records = records
+        self.extra = extra
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, field):
+        return self.records[field]
+
+
+def read_metrics(data_file, name=None):
+    """ Read an InterOp file with one of the layouts in INTEROP_FORMATS.
+    :param file data_file: an open file-like object, at the start of the file
+    :param name: the file name that selects the layout, or None for the base
+    name of data_file.
+    :return: InteropMetrics
+    """
+    if name is None:
+        name = os.path.basename(data_file.name)
+    version, record_length, dtype, extra = read_metrics_header(data_file, name)
+    records = read_body(data_file, dtype, record_length)
+    return InteropMetrics(name, version, records, extra)
+
+
+def read_metrics_header(data_file, name):
+    """ Read the header of an InterOp file with one of the layouts in
+    INTEROP_FORMATS, including any values after the record length.  A version
+    without a declared layout is read with the layout of the closest earlier
+    version, as newer versions usually only add fields to the end of each
+    record, and a warning is printed.
+    :return: (version, record_length, dtype of records, extra header values)
+    """
+    formats = INTEROP_FORMATS.get(name)
+    if formats is None:
+        raise IOError('Unknown InterOp file type {}.'.format(name))
+    version, record_length = read_header(data_file, min(formats))
+    record_format = formats.get(version)
+    if record_format is None:
+        known_version = max(known for known in formats if known < version)
+        print 'WARNING: reading version {} of {} with the layout of version {}'.format(
+            version,
+            data_file.name,
+            known_version)
+        record_format = formats[known_version]
+    extra = record_format.read_extra and record_format.read_extra(data_file)
+    return version, record_length, record_format.dtype(record_length), extra
+
+
+def follow_metrics(path, name=None, interval=30.0, idle_timeout=None, sleep=time.sleep):
+    """ Follow an InterOp file that is still being written, like tail -f.
+
+    The byte offset after the last complete record is kept between polls of
+    the file size, and only the records added since then are read, so each
+    poll costs time in proportion to the new records.  A partial record at
+    the end of the file is left until it is complete.
+    :param path: path of the InterOp file, which may not exist yet.
+    :param name: the file name that selects the layout, or None for the base
+    name of path.
+    :param float interval: seconds to wait between polls of the file size.
+    :param idle_timeout: stop after this many seconds without new records,
+    or None to follow the file until the caller stops.
+    :return: an iterator over structured arrays of the new records, starting
+    with all complete records already in the file.
+    """
+    if name is None:
+        name = os.path.basename(path)
+    idle = 0.0
+    while not os.path.exists(path) or os.path.getsize(path) < 2:
+        if idle_timeout is not None and idle >= idle_timeout:
+            return
+        sleep(interval)
+        idle += interval
+
+    with open(path, 'rb') as data_file:
+        _version, record_length, dtype, _extra = read_metrics_header(data_file, name)
+        record_dtype = _record_dtype(data_file, dtype, record_length)
+        offset = data_file.tell()
+        while True:
+            size = os.fstat(data_file.fileno()).st_size
+            if size < offset:
+                raise IOError('File {} was truncated.'.format(path))
+            count = (size - offset) // record_length
+            if count:
+                data_file.seek(offset)
+                data = data_file.read(count * record_length)
+                offset += len(data)
+                idle = 0.0
+                yield np.frombuffer(data, record_dtype)
+            elif idle_timeout is not None and idle >= idle_timeout:
+                return
+            else:
+                sleep(interval)
+                idle += interval
+
+
+class RunningErrorRates(object):
+    """ Running sums of phiX error rates per tile and cycle, updated with each
+    array of new records from follow_metrics(), so that the rates are never
+    summed again from the start of the file.
+    """
+    def __init__(self):
+        self.tiles = np.zeros(0, np.int64)  # sorted tile numbers
+        self.sums = np.zeros((0, 0))  # [tile, cycle-1], with spare cycles
+        self.counts = np.zeros((0, 0), np.int64)
+        self.cycle_sums = np.zeros(0)
+        self.cycle_counts = np.zeros(0, np.int64)
+        self.cycle_count = 0
+        self.record_count = 0
+
+    def _reserve(self, tiles, cycle_count):
+        """ Add rows for new tiles, and columns for cycles up to cycle_count """
+        new_tiles = np.setdiff1d(tiles, self.tiles)
+        capacity = self.sums.shape[1]
+        if cycle_count > capacity:
+            capacity = max(cycle_count, 2 * capacity)
+        if len(new_tiles) == 0 and capacity == self.sums.shape[1]:
+            return
+        all_tiles = np.union1d(self.tiles, new_tiles)
+        rows = np.searchsorted(all_tiles, self.tiles)
+        old_capacity = self.sums.shape[1]
+        for attr in ('sums', 'counts'):
+            old = getattr(self, attr)
+            new = np.zeros((len(all_tiles), capacity), old.dtype)
+            new[rows, :old_capacity] = old
+            setattr(self, attr, new)
+        for attr in ('cycle_sums', 'cycle_counts'):
+            old = getattr(self, attr)
+            new = np.zeros(capacity, old.dtype)
+            new[:old_capacity] = old
+            setattr(self, attr, new)
+        self.tiles = all_tiles
+
+    def update(self, records):
+        """ Add an array of records with the fields of ERROR_DTYPE """
+        if len(records) == 0:
+            return
+        tiles = records['tile'].astype(np.int64)
+        columns = records['cycle'].astype(np.int64) - 1
+        rates = records['error_rate'].astype(np.float64)
+        self.cycle_count = max(self.cycle_count, columns.max() + 1)
+        self._reserve(np.unique(tiles), self.cycle_count)
+        rows = np.searchsorted(self.tiles, tiles)
+        np.add.at(self.sums, (rows, columns), rates)
+        np.add.at(self.counts, (rows, columns), 1)
+        np.add.at(self.cycle_sums, columns, rates)
+        np.add.at(self.cycle_counts, columns, 1)
+        self.record_count += len(records)
+
+    def error_rates(self):
+        """ Return the mean error rate of each [tile, cycle-1], or NaN where
+        there are no records. """
+        sums = self.sums[:, :self.cycle_count]
+        counts = self.counts[:, :self.cycle_count]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, sums / counts, np.nan)
+
+    def summary(self, read_lengths=None):
+        """ Return the mean error rates of the forward and reverse reads so
+        far, with the same keys as the summary of write_phix_csv(). """
+        max_forward_cycle = read_lengths and read_lengths[0] or self.cycle_count
+        min_reverse_cycle = read_lengths and sum(read_lengths[:-1])+1 or self.cycle_count+1
+        summary = {}
+        for key, cycles in (('error_rate_fwd', slice(0, max_forward_cycle)),
+                            ('error_rate_rev', slice(min_reverse_cycle-1, self.cycle_count))):
+            count = self.cycle_counts[cycles].sum()
+            if count > 0:
+                summary[key] = self.cycle_sums[cycles].sum() / count
+        return summary
+
+
+def read_interop_dir(path):
+    """ Read every InterOp file with a known layout in a directory.
+    :param path: an InterOp directory, or a run folder that contains one.
+    :return: {file name: InteropMetrics}
+    """
+    if os.path.isdir(os.path.join(path, 'InterOp')):
+        path = os.path.join(path, 'InterOp')
+    metrics = {}
+    for name in sorted(INTEROP_FORMATS):
+        file_path = os.path.join(path, name)
+        if os.path.exists(file_path):
+            with open(file_path, 'rb') as data_file:
+                metrics[name] = read_metrics(data_file)
+    return metrics
+
+
+def _group_reduce(records, keys, field):
+    """ Sum a field over groups of records, and count the records in each """
+    key_array = np.empty(len(records), [(key, records.dtype[key]) for key in keys])
+    for key in keys:
+        key_array[key] = records[key]
+    groups, index = np.unique(key_array, return_inverse=True)
+    values = records[field]
+    total_type = np.float64 if values.dtype.kind == 'f' else np.int64
+    counts = np.bincount(index, minlength=len(groups))
+    if len(groups) == 0:
+        return groups, np.zeros((0,) + values.shape[1:], total_type), counts
+    order = np.argsort(index, kind='mergesort')
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    sums = np.add.reduceat(values[order].astype(total_type), starts, axis=0)
+    return groups, sums, counts
+
+
+def group_sum(records, keys, field):
+    """ Sum a field over the records that share values of the key fields.
+    :param records: a structured array, or InteropMetrics
+    :param keys: list of field names to group by, such as ['lane', 'tile']
+    :param field: name of the field to sum, which may be an array per record
+    :return: (structured array of distinct keys in sorted order, array of sums)
+    """
+    if isinstance(records, InteropMetrics):
+        records = records.records
+    groups, sums, _counts = _group_reduce(records, keys, field)
+    return groups, sums
+
+
+def group_mean(records, keys, field):
+    """ Average a field over the records that share values of the key fields,
+    as group_sum() does.
+    :return: (structured array of distinct keys in sorted order, array of means)
+    """
+    if isinstance(records, InteropMetrics):
+        records = records.records
+    groups, sums, counts = _group_reduce(records, keys, field)
+    return groups, sums / counts.reshape((-1,) + (1,) * (sums.ndim - 1))
+
+
+def qscores(metrics):
+    """ Return the quality score counted by each histogram column of
+    QMetricsOut.bin metrics. """
+    width = metrics.records.dtype['histogram'].shape[0]
+    if metrics.extra is not None and width == len(metrics.extra['value']):
+        return metrics.extra['value'].astype(int)
+    return np.arange(1, width + 1)
+
+
+def q30_by_cycle(metrics, keys=('cycle',)):
+    """ Calculate the fraction of base calls with quality of at least 30.
+    :param metrics: InteropMetrics from QMetricsOut.bin
+    :param keys: fields to group by
+    :return: (structured array of distinct keys in sorted order, array of
+    fractions of calls with Q30 or more)
+    """
+    groups, histograms = group_sum(metrics, list(keys), 'histogram')
+    totals = histograms.sum(axis=1)
+    q30 = histograms[:, qscores(metrics) >= 30].sum(axis=1)
+    return groups, q30 / np.maximum(totals, 1).astype(float)
+
+
+def read_error_array(data_file):
+    """ Read error rate data from a phiX data file into a structured array.
+
+    :param file data_file: an open file-like object, as for read_errors().
+    :return: a structured array with the fields of ERROR_DTYPE, memory-mapped
+    if data_file is a regular file.
+    """
+    return read_metrics(data_file, 'ErrorMetricsOut.bin').records
+
+
 def read_errors(data_file):
     """ Read error rate data from a phiX data file.
 
@@ -60,41 +488,83 @@ def read_errors(data_file):
     - num_3_errors [uint32]
     - num_4_errors [uint32]
     """
-    PARSED_LENGTH = 30
-    for data in read_records(data_file, min_version=3):
-        fields = unpack('<HHHfLLLLL', data[:PARSED_LENGTH])
-        yield dict(lane=fields[0],
-                   tile=fields[1],
-                   cycle=fields[2],
-                   error_rate=fields[3],
-                   num_0_errors=fields[4],
-                   num_1_error=fields[5],
-                   num_2_errors=fields[6],
-                   num_3_errors=fields[7],
-                   num_4_errors=fields[8])
-
-
-def _yield_cycles(records, read_lengths):
-    sorted_records = map(itemgetter('tile', 'cycle', 'error_rate'), records)
-    try:
-        sorted_records.sort()
-    except:
-        print (sorted_records)
-        raise
+    for fields in read_error_array(data_file).tolist():
+        yield dict(zip(ERROR_DTYPE.names, fields))
+
+
+def _as_columns(records):
+    """ Return the tile, cycle and error rate columns of records, which may be
+    a structured array or a sequence of dictionaries from read_errors(). """
+    if isinstance(records, InteropMetrics):
+        records = records.records
+    if not isinstance(records, np.ndarray):
+        rows = map(itemgetter('tile', 'cycle', 'error_rate'), records)
+        records = np.array(rows, [('tile', np.int64),
+                                  ('cycle', np.int64),
+                                  ('error_rate', np.float64)]).reshape(-1)
+    return (records['tile'].astype(np.int64),
+            records['cycle'].astype(np.int64),
+            records['error_rate'].astype(np.float64))
+
+
+def phix_cycles(records, read_lengths=None, summary=None):
+    """ Arrange phiX error rates on a dense grid of tiles and cycles.
+
+    Records are sorted by tile and cycle.  Cycles of the reverse read are
+    renumbered as negative cycles, index cycles are dropped, and each tile's
+    forward and reverse reads are reindexed onto every cycle from 1 (or -1) to
+    the read length, or to the last cycle with a record if there are no read
+    lengths.  Cycles are numbered from 1.
+    :param records: a structured array from read_error_array(), or a sequence
+    of dictionaries like those yielded from read_errors().
+    :param read_lengths: a list of lengths for each type of read: forward,
+    indexes, and reverse
+    :param dict summary: a dictionary to hold the summary values:
+    error_rate_fwd and error_rate_rev.
+    :return: (tiles, cycles, error_rates) arrays with one element per row,
+    where missing cycles have an error rate of NaN.
+    """
+    tiles, cycles, rates = _as_columns(records)
+    order = np.lexsort((rates, cycles, tiles))
+    tiles, cycles, rates = tiles[order], cycles[order], rates[order]
+
     max_forward_cycle = read_lengths and read_lengths[0] or sys.maxint
     min_reverse_cycle = read_lengths and sum(read_lengths[:-1])+1 or sys.maxint
-    for record in sorted_records:
-        cycle = record[1]
-        if cycle >= min_reverse_cycle:
-            cycle = min_reverse_cycle - cycle - 1
-            yield record[0], cycle, record[2]
-        elif cycle <= max_forward_cycle:
-            yield record
+    is_reverse = cycles >= min_reverse_cycle
+    keep = is_reverse | (cycles <= max_forward_cycle)
+    cycles = np.where(is_reverse, min_reverse_cycle - cycles - 1, cycles)
+    tiles, cycles, rates, is_reverse = tiles[keep], cycles[keep], rates[keep], is_reverse[keep]
 
+    # summaries add the error rates in the order of the rows
+    if summary is not None:
+        for key, selected in (('error_rate_fwd', ~is_reverse), ('error_rate_rev', is_reverse)):
+            if selected.any():
+                summary[key] = float(np.cumsum(rates[selected])[-1]) / int(selected.sum())
 
-def _record_grouper(record):
-    # Group by tile and sign of cycle (forward or reverse).
-    return (record[0], int(math.copysign(1, record[1])))
+    # one block of the grid for each tile's forward and reverse read
+    is_new_block = np.ones(len(tiles), dtype=bool)
+    is_new_block[1:] = (tiles[1:] != tiles[:-1]) | (is_reverse[1:] != is_reverse[:-1])
+    block_index = np.cumsum(is_new_block) - 1
+    block_tiles = tiles[is_new_block]
+    block_signs = np.where(is_reverse[is_new_block], -1, 1)
+    positions = np.abs(cycles)
+    block_lengths = positions[np.roll(is_new_block, -1)]  # last cycle of each block
+    if read_lengths:
+        block_lengths = np.maximum(block_lengths,
+                                   np.where(block_signs == 1, read_lengths[0], read_lengths[-1]))
+    block_starts = np.cumsum(block_lengths) - block_lengths
+    grid_size = block_lengths.sum()
+    grid_block = np.repeat(np.arange(len(block_tiles)), block_lengths)
+    grid_cycles = (np.arange(grid_size) - block_starts[grid_block] + 1) * block_signs[grid_block]
+
+    # every record, and a blank row in each cell of the grid without one
+    record_cells = block_starts[block_index] + positions - 1
+    blank_cells = np.flatnonzero(np.bincount(record_cells, minlength=grid_size) == 0)
+    row_order = np.argsort(np.concatenate((record_cells, blank_cells)), kind='mergesort')
+    row_blocks = np.concatenate((block_index, grid_block[blank_cells]))[row_order]
+    row_cycles = np.concatenate((cycles, grid_cycles[blank_cells]))[row_order]
+    row_rates = np.concatenate((rates, np.full(len(blank_cells), np.nan)))[row_order]
+    return block_tiles[row_blocks], row_cycles, row_rates
 
 
 def write_phix_csv(out_file, records, read_lengths=None, summary=None):
@@ -103,40 +573,53 @@ def write_phix_csv(out_file, records, read_lengths=None, summary=None):
     Missing cycles are written with blank error rates, index reads are not
     written, and reverse reads are written with negative cycles.
     :param out_file: an open file to write to
-    :param records: a sequence of dictionaries like those yielded from
-    read_phix().
+    :param records: a structured array from read_error_array(), or a sequence
+    of dictionaries like those yielded from read_errors().
     :param read_lengths: a list of lengths for each type of read: forward,
     indexes, and reverse
     :param dict summary: a dictionary to hold the summary values:
     error_rate_fwd and error_rate_rev.
     """
-    writer = csv.writer(out_file, lineterminator=os.linesep)
-    writer.writerow(['tile', 'cycle', 'errorrate'])
-
-    error_sums = [0.0, 0.0]
-    error_counts = [0, 0]
-    for (_tile, sign), group in groupby(_yield_cycles(records, read_lengths),
-                                        _record_grouper):
-        previous_cycle = 0
-        for record in group:
-            cycle = record[1]
-            previous_cycle += sign
-            while previous_cycle*sign < cycle*sign:
-                writer.writerow((record[0], previous_cycle))
-                previous_cycle += sign
-            writer.writerow(record)
-            summary_index = (sign+1)/2
-            error_sums[summary_index] += record[2]
-            error_counts[summary_index] += 1
-        if read_lengths:
-            read_length = read_lengths[0] if sign == 1 else -read_lengths[-1]
-            while previous_cycle*sign < read_length*sign:
-                previous_cycle += sign
-                writer.writerow((record[0], previous_cycle))
-    if error_counts[1] > 0 and summary is not None:
-        summary['error_rate_fwd'] = error_sums[1]/error_counts[1]
-    if error_counts[0] > 0 and summary is not None:
-        summary['error_rate_rev'] = error_sums[0]/error_counts[0]
+    tiles, cycles, rates = phix_cycles(records, read_lengths, summary)
+    rate_text = [',' + repr(rate) if rate == rate else '' for rate in rates.tolist()]
+    rows = ['tile,cycle,errorrate']
+    rows.extend(itertools.imap('{},{}{}'.format, tiles.tolist(), cycles.tolist(), rate_text))
+    rows.append('')
+    out_file.write(os.linesep.join(rows))
+
+
+def write_phix_npz(out_file, records, read_lengths=None, summary=None):
+    """ Write phiX error rate data to a NumPy .npz file of columns, as arrays
+    tile, cycle and errorrate, with the same rows as write_phix_csv().  Missing
+    cycles have an error rate of NaN.
+    """
+    tiles, cycles, rates = phix_cycles(records, read_lengths, summary)
+    np.savez_compressed(out_file,
+                        tile=tiles.astype(np.uint16),
+                        cycle=cycles.astype(np.int16),
+                        errorrate=rates.astype(np.float32))
+
+
+def read_run_info(handle):
+    """ Read the length of each read of a run from its RunInfo.xml file.
+    :param handle: an open RunInfo.xml file, or its path
+    :return: a list of the number of cycles in each read, in the order of the
+    reads: forward, indexes, and reverse.
+    """
+    reads = ElementTree.parse(handle).getroot().findall('.//Reads/Read')
+    for read in reads:
+        if read.get('Number') is None or read.get('NumCycles') is None:
+            raise ValueError('Read without Number or NumCycles in RunInfo.xml')
+    reads.sort(key=lambda read: int(read.get('Number')))
+    return [int(read.get('NumCycles')) for read in reads]
+
+
+def find_run_info(bin_path):
+    """ Return the path of the RunInfo.xml file in the run folder above the
+    InterOp folder of an InterOp file, or None if there is none. """
+    interop_dir = os.path.dirname(os.path.abspath(bin_path))
+    path = os.path.join(os.path.dirname(interop_dir), 'RunInfo.xml')
+    return path if os.path.exists(path) else None
 
 
 def parse_interop(handle, outfile):
@@ -147,25 +630,57 @@ def parse_interop(handle, outfile):
         writer.writerow(record)
 
 def read_tiles(handle):
-    PARSED_LENGTH = 10
-    for data in read_records(handle, min_version=2):
-        fields = unpack('<HHHf', data[:PARSED_LENGTH])
-        yield dict(
-            lane=fields[0],
-            tile=fields[1],
-            metric_code=fields[2],
-            metric_value=fields[3]
-        )
+    for fields in read_metrics(handle, 'TileMetricsOut.bin').records.tolist():
+        yield dict(zip([field[0] for field in TILE_FIELDS], fields))
 
 def main():
     aparser = argparse.ArgumentParser(description='Extract phiX174 error rates from InterOp file')
-    aparser.add_argument('bin', type=argparse.FileType('rb'), help='ErrorMetricsOut.bin file from run')
-    aparser.add_argument('output', type=argparse.FileType('w'), help='File to write CSV output')
+    aparser.add_argument('bin', help='ErrorMetricsOut.bin file from run')
+    aparser.add_argument('output', type=argparse.FileType('wb'), help='File to write CSV output')
+    aparser.add_argument('-read_lengths', type=int, nargs='+', default=None,
+                         help='Length of each read: forward, indexes, and reverse.  Leave '
+                              'blank to read them from the RunInfo.xml file of the run folder, '
+                              'or to use 300 8 8 300 if there is none.')
+    aparser.add_argument('-format', choices=['csv', 'npz'], default='csv',
+                         help='Write CSV, or NumPy .npz columns of tile, cycle and errorrate')
+    aparser.add_argument('-follow', action='store_true',
+                         help='Follow the file while the instrument writes it, and report '
+                              'error rates as records are added; the output is written when '
+                              'the file stops growing or on Ctrl-C')
+    aparser.add_argument('-interval', type=float, default=30.0,
+                         help='Seconds between checks for new records with -follow')
+    aparser.add_argument('-idle_timeout', type=float, default=3600.0,
+                         help='Seconds without new records before -follow stops')
     args = aparser.parse_args()
 
+    read_lengths = args.read_lengths
+    if read_lengths is None:
+        run_info = find_run_info(args.bin)
+        read_lengths = DEFAULT_READ_LENGTHS if run_info is None else read_run_info(run_info)
     #parse_interop(args.bin, args.output)
-    records = read_errors(args.bin)
-    write_phix_csv(args.output, records, [300, 8, 8, 300], {})
+    if args.follow:
+        rates = RunningErrorRates()
+        batches = []
+        try:
+            for records in follow_metrics(args.bin, 'ErrorMetricsOut.bin', args.interval,
+                                          args.idle_timeout):
+                rates.update(records)
+                batches.append(records)
+                summary = rates.summary(read_lengths)
+                print '{} records to cycle {}: forward {}, reverse {}'.format(
+                    rates.record_count,
+                    rates.cycle_count,
+                    summary.get('error_rate_fwd', 'NA'),
+                    summary.get('error_rate_rev', 'NA'))
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+        records = np.concatenate(batches) if batches else np.zeros(0, ERROR_DTYPE)
+    else:
+        with open(args.bin, 'rb') as data_file:
+            records = read_error_array(data_file)
+    write = write_phix_npz if args.format == 'npz' else write_phix_csv
+    write(args.output, records, read_lengths, {})
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,146 @@
+"""
+Update reference sequences as adapt-ref.py does, and slice merged read pairs
+as slice-sam.py does, from a single pass over a SAM or BAM file.
+
+Running the two scripts one after the other reads and splits every line of
+the file twice.  Here each line is split once into a row, and the stream of
+rows is passed both to the pileup (or streaming consensus) of adapt-ref.py
+and to the mate pairing and merging of slice-sam.py.
+"""
+import os
+import imp
+import sys
+import argparse
+
+scripts = os.path.dirname(os.path.abspath(__file__))
+adapt_ref = imp.load_source('adapt_ref', os.path.join(scripts, 'adapt-ref.py'))
+slice_sam = imp.load_source('slice_sam', os.path.join(scripts, 'slice-sam.py'))
+from bamfile import open_alignments
+
+
+class ConsensusStage(object):
+    """
+    Consumer of mapped reads for adapt-ref.py.  Reads are passed to a
+    ConsensusStream if the input is sorted by coordinate, and otherwise
+    counted in a pileup of each reference.  If sorted input turns out not to
+    be sorted, the remaining reads are ignored and unsorted is set, because
+    the reads that were streamed have already been dropped.
+    """
+    def __init__(self, qCutoff, stream=False):
+        self.stream = adapt_ref.ConsensusStream(qCutoff) if stream else None
+        self.result = ({}, {})
+        self.conseqs = {}
+        self.unsorted = False
+
+    def __call__(self, rname, rpos, cigar, seq, qual):
+        if self.unsorted:
+            return
+        if self.stream is None:
+            adapt_ref.count_read(self.result, rname, rpos, cigar, seq, qual)
+            return
+        try:
+            for refname, conseq, ncovered in self.stream.add(rname, rpos, cigar, seq, qual):
+                self.conseqs[refname] = (conseq, ncovered)
+        except ValueError:
+            self.unsorted = True
+
+    def sources(self):
+        """ Return {refname: source} for adapt_ref.write_references() """
+        if self.stream is None:
+            return self.result[0]
+        for refname, conseq, ncovered in self.stream.close():
+            self.conseqs[refname] = (conseq, ncovered)
+        return self.conseqs
+
+
+def tokenize(lines):
+    """ Split each alignment line of SAM once, and yield (line, row) tuples
+    where row is the dictionary from slice_sam.parse_row() """
+    for line in lines:
+        if line.startswith('@'):
+            continue
+        yield line, slice_sam.parse_row(line)
+
+
+def tap(records, consumer):
+    """
+    Pass the fields of every mapped read in a stream of (line, row) tuples
+    to consumer(refname, position, cigar, seq, qual), and yield the tuples on.
+    """
+    for line, row in records:
+        if row['cigar'] != '*':
+            consumer(row['rname'], int(row['pos']), row['cigar'], row['seq'], row['qual'])
+        yield line, row
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate new reference sequences from the consensus of mapped '
+                    'reads (adapt-ref.py), and an alignment of merged read pairs '
+                    '(slice-sam.py), in a single pass over a SAM or BAM file.'
+    )
+    parser.add_argument('sam', type=str,
+                        help='<input> SAM or BAM generated by short read mapping')
+    parser.add_argument('ref', type=argparse.FileType('rU'),
+                        help='<input> FASTA file containing reference')
+    parser.add_argument('out_ref', type=argparse.FileType('w'),
+                        help='<output> FASTA file with updated reference')
+    parser.add_argument('out', type=str,
+                        help='<output> FASTA of aligned reads, labelled as by slice-sam.py')
+
+    slice_sam.add_slice_arguments(parser)
+    parser.add_argument('-conseq_qcut', type=int, default=10,
+                        help='Quality score cutoff for the consensus sequences, one of %s' %
+                             ', '.join(map(str, adapt_ref.Q_CUTOFFS)))
+    parser.add_argument('-band', type=int, default=100,
+                        help='Band width for aligning consensus to reference')
+    parser.add_argument('-mafft', action='store_true',
+                        help='Align consensus to reference with MAFFT')
+    parser.add_argument('-no_stream', action='store_true',
+                        help='Do not stream coordinate-sorted input, load the whole '
+                             'pileup instead')
+    parser.add_argument('-threads', type=int, default=1,
+                        help='Number of processes used to merge read pairs and to '
+                             'update references, and of threads used to decompress '
+                             'BAM input.')
+    args = parser.parse_args()
+    if args.conseq_qcut not in adapt_ref.Q_CUTOFFS:
+        # pileups only count quality scores between these cutoffs
+        print 'ERROR: -conseq_qcut must be one of %s' % ', '.join(map(str, adapt_ref.Q_CUTOFFS))
+        sys.exit()
+
+    refs = [(h.split()[0], s) for h, s in adapt_ref.convert_fasta(args.ref)]
+    window_list = None if args.windows is None else slice_sam.read_windows(args.windows)
+
+    header, lines = adapt_ref.read_header(open_alignments(args.sam, threads=args.threads))
+    references, _ = slice_sam.read_header(header)
+    windows, is_multi = slice_sam.select_windows(args, references, window_list)
+    assert args.threads > 0, "threads must be greater than zero."
+    is_qname_sorted = any(line.startswith('@HD') and 'SO:queryname' in line for line in header)
+    stream = adapt_ref.is_coordinate_sorted(header) and not args.no_stream
+
+    qcuts = sorted(set(args.qcut))
+    outputs = slice_sam.open_outputs(args.out, windows, qcuts, is_multi, args.windows is not None)
+    stage = ConsensusStage(args.conseq_qcut, stream)
+    region = slice_sam.RegionFilter(windows, args.min_overlap)
+    pairs = slice_sam.pair_rows(tap(tokenize(lines), stage), set(windows.windows),
+                                is_qname_sorted, args.max_memory * 2**20)
+    reads = slice_sam.merge_read_pairs(pairs, qcuts, args.maxN,
+                                       slice_sam.MERGE_ENGINES[args.engine], region, args.threads)
+    slice_sam.write_slices(reads, windows, outputs, args.min_overlap)
+    print 'Pruned %d of %d read pairs outside region' % (region.pruned, region.pruned + region.kept)
+
+    if stage.unsorted:
+        if args.sam == '-':
+            print 'ERROR: SAM input declared as sorted by coordinate is not sorted'
+            sys.exit()
+        print 'WARNING: SAM file is not sorted by coordinate, reading it again for pileup'
+        sources = adapt_ref.build_pileup(args.sam, args.threads)[0]
+    else:
+        sources = stage.sources()
+    adapt_ref.write_references(args.out_ref, refs, sources, args.conseq_qcut,
+                               args.band, args.mafft, args.threads)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,21 @@
 import re
+import os
 import sys
 import argparse
+import heapq
+import bisect
+import tempfile
 import itertools
+import multiprocessing
+from collections import OrderedDict, defaultdict, deque
+from operator import itemgetter
+
+from bamfile import open_alignments
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # vectorized merge engine is not available
 
 
 def apply_cigar(cigar, seq, qual, pos=0, clip_from=0, clip_to=None):
@@ -30,50 +44,169 @@ def apply_cigar(cigar, seq, qual, pos=0, clip_from=0, clip_to=None):
         the value. If none of the read was within the clipped range, then both
         strings will be blank and the dictionary will be empty.
     """
-    newseq = '-' * int(pos)  # pad on left
-    newqual = '!' * int(pos)
-    insertions = {}
-    is_valid = re.match(r'^((\d+)([MIDNSHPX=]))*$', cigar)
-    tokens = re.findall(r'  (\d+)([MIDNSHPX=])', cigar, re.VERBOSE)
-    if not is_valid:
-        raise RuntimeError('Invalid CIGAR string: {!r}.'.format(cigar))
-    end = None if clip_to is None else clip_to + 1
-    left = 0
-    for token in tokens:
-        length, operation = token
-        length = int(length)
-        # Matching sequence: carry it over
-        if operation == 'M':
-            newseq += seq[left:(left+length)]
-            newqual += qual[left:(left+length)]
-            left += length
-        # Deletion relative to reference: pad with gaps
-        elif operation == 'D':
-            newseq += '-'*length
-            newqual += ' '*length  # Assign fake placeholder score (Q=-1)
-        # Insertion relative to reference
-        elif operation == 'I':
+    plan = cigar_cache.get(cigar)
+    return plan.apply(seq, qual, pos, clip_from, clip_to)
+
+
+class CigarPlan(object):
+    """ A CIGAR string compiled into a slicing plan that can be applied to
+    any read with the same alignment.
+
+    Attributes:
+        operations: list of validated (length, operation) tuples
+        query_length: number of read bases consumed by the CIGAR (M, I, S)
+        ref_span: number of reference positions covered by the CIGAR (M, D)
+        matches: list of (query_start, new_start, length) slices for each M
+        insertions: list of (query_start, length) for each I
+    """
+    def __init__(self, cigar):
+        if not re.match(r'^((\d+)([MIDNSHPX=]))*$', cigar):
+            raise RuntimeError('Invalid CIGAR string: {!r}.'.format(cigar))
+        self.cigar = cigar
+        self.operations = []
+        self.matches = []
+        self.insertions = []
+        self.unsupported = None  # (token, query_length before token)
+        left = 0
+        right = 0
+        for length, operation in re.findall(r'(\d+)([MIDNSHPX=])', cigar):
+            length = int(length)
+            if operation == 'M':
+                self.matches.append((left, right, length))
+                left += length
+                right += length
+            elif operation == 'D':
+                right += length
+            elif operation == 'I':
+                self.insertions.append((left, length))
+                left += length
+            elif operation == 'S':
+                left += length
+            else:
+                self.unsupported = (length, operation, left)
+                break
+            self.operations.append((length, operation))
+        self.query_length = left
+        self.ref_span = right
+
+    def apply(self, seq, qual, pos=0, clip_from=0, clip_to=None):
+        """ Apply this plan to a read.  See apply_cigar() for details. """
+        if self.unsupported is not None:
+            length, operation, left = self.unsupported
+            if left <= len(seq):
+                raise RuntimeError('Unsupported CIGAR token: {!r}.'.format(
+                    '{}{}'.format(length, operation)))
+        if self.query_length > len(seq):
+            raise RuntimeError(
+                'CIGAR string {!r} is too long for sequence {!r}.'.format(self.cigar,
+                                                                          seq))
+        if self.query_length < len(seq):
+            raise RuntimeError(
+                'CIGAR string {!r} is too short for sequence {!r}.'.format(self.cigar,
+                                                                           seq))
+        pos = int(pos)
+        end = None if clip_to is None else clip_to + 1
+
+        # pad on left, and assign fake placeholder score (Q=-1) to deletions
+        newseq = bytearray('-' * (pos + self.ref_span))
+        newqual = bytearray('!' * pos + ' ' * self.ref_span)
+        for left, right, length in self.matches:
+            newseq[(pos+right):(pos+right+length)] = seq[left:(left+length)]
+            newqual[(pos+right):(pos+right+length)] = qual[left:(left+length)]
+
+        insertions = {}
+        for left, length in self.insertions:
             if end is None or left+pos < end:
                 insertions[left+pos-clip_from] = (seq[left:(left+length)],
                                                   qual[left:(left+length)])
-            left += length
-        # Soft clipping leaves the sequence in the SAM - so we should skip it
-        elif operation == 'S':
-            left += length
+
+        return str(newseq[clip_from:end]), str(newqual[clip_from:end]), insertions
+
+
+class CigarCache(object):
+    """ Bounded least-recently-used cache of CigarPlan objects, keyed by CIGAR
+    string.  Real runs reuse a small set of CIGAR strings across millions of
+    reads, so the hits and misses counters can be used to tune maxsize.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.plans = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cigar):
+        plan = self.plans.pop(cigar, None)
+        if plan is None:
+            self.misses += 1
+            plan = CigarPlan(cigar)
+            if len(self.plans) >= self.maxsize:
+                self.plans.popitem(last=False)  # evict least recently used
         else:
-            raise RuntimeError('Unsupported CIGAR token: {!r}.'.format(
-                ''.join(token)))
-        if left > len(seq):
-            raise RuntimeError(
-                'CIGAR string {!r} is too long for sequence {!r}.'.format(cigar,
-                                                                          seq))
+            self.hits += 1
+        self.plans[cigar] = plan  # mark as most recently used
+        return plan
+
+
+cigar_cache = CigarCache()
+
+
+class AlignedRead(object):
+    """ A read aligned to the reference, stored without left padding.
 
-    if left < len(seq):
-        raise RuntimeError(
-            'CIGAR string {!r} is too short for sequence {!r}.'.format(cigar,
-                                                                       seq))
+    The padded form used by earlier versions of this script ('-'*ref_offset
+    followed by the sequence) is only materialized for the clipped interval
+    that gets written out, so memory and CPU per read scale with read length
+    instead of genome position.
 
-    return newseq[clip_from:end], newqual[clip_from:end], insertions
+    Attributes:
+        ref_offset: zero-based reference coordinate of the first position
+        seq: base calls starting at ref_offset, with deletions as '-'
+        qual: quality string aligned with seq, or None for merged reads
+        insertions: {pos: (insert_seq, insert_qual)} as returned by apply_cigar
+    """
+    def __init__(self, ref_offset, seq, qual=None, insertions=None):
+        self.ref_offset = ref_offset
+        self.seq = seq
+        self.qual = qual
+        self.insertions = insertions or {}
+
+    @property
+    def ref_end(self):
+        """ Reference coordinate following the last position of the read """
+        return self.ref_offset + len(self.seq)
+
+    def clip(self, left, right=None):
+        """ Equivalent to ('-'*ref_offset + seq)[left:right] """
+        if right is None:
+            right = self.ref_end
+        prefix = '-' * max(0, min(self.ref_offset, right) - left)
+        start = max(0, left - self.ref_offset)
+        end = max(0, right - self.ref_offset)
+        return prefix + self.seq[start:end]
+
+
+def merge_reads(read1, read2, merge, q_cutoffs=(10,)):
+    """ Merge two AlignedReads over the interval that they span.
+
+    Only the positions from the start of the first read to the end of the
+    last read are passed to the merge function; the gap prefix shared by
+    both padded reads would be copied unchanged into the merged sequence.
+    @param merge: merge_pairs or merge_pairs_numpy
+    @param q_cutoffs: list of quality cutoffs to merge with
+    @return: {q_cutoff: read} AlignedReads with the merged sequence and no
+        quality string
+    """
+    offset = min(read1.ref_offset, read2.ref_offset)
+    pad1 = read1.ref_offset - offset
+    pad2 = read2.ref_offset - offset
+    # assign lowest quality to gap prefix so it does not override mate
+    mseqs = merge_pairs_cutoffs('-'*pad1 + read1.seq,
+                                '-'*pad2 + read2.seq,
+                                '!'*pad1 + read1.qual,
+                                '!'*pad2 + read2.qual,
+                                q_cutoffs,
+                                merge=merge)
+    return dict((q_cutoff, AlignedRead(offset, mseq)) for q_cutoff, mseq in mseqs.iteritems())
 
 
 def merge_pairs(seq1,
@@ -166,6 +299,191 @@ def merge_pairs(seq1,
     return mseq
 
 
+KEEP_CALL = 2**15 - 1  # quality assigned to calls that are never censored
+KEEP_CALL_CHAR = chr(127)  # quality character above every cutoff, for resolve_pairs()
+NO_CALL_CHAR = chr(0)  # quality character of calls that are already N
+
+
+def resolve_pairs(seq1, seq2, qual1, qual2, minimum_q_delta=5):
+    """
+    Resolve the base call at each aligned column of two reads, independent
+    of the quality cutoff, with a loop over every column as merge_pairs()
+    does.  This is the pure Python equivalent of resolve_pairs_numpy(),
+    with the quality of each call as a character, KEEP_CALL_CHAR for calls
+    that do not depend on the cutoff, and NO_CALL_CHAR for unresolved
+    discordant bases.  The merged sequence for any q_cutoff is given by
+    censor_resolved().
+    @return: (calls, quals) strings of the same length
+    """
+    # force second read to be longest of the two
+    if len(seq1) > len(seq2):
+        seq1, seq2 = seq2, seq1
+        qual1, qual2 = qual2, qual1
+
+    calls = []
+    quals = []
+    is_forward_started = False
+    is_reverse_started = False
+    for i, c2 in enumerate(seq2):
+        if c2 != '-':
+            is_reverse_started = True
+        if i < len(seq1):
+            c1 = seq1[i]
+            if c1 == '-' and c2 == '-':
+                if is_forward_started:
+                    calls.append('-')
+                    quals.append(KEEP_CALL_CHAR)
+                continue
+            if not is_forward_started:
+                is_forward_started = True
+                calls.append('-' * i)
+                quals.append(KEEP_CALL_CHAR * i)
+            q1 = qual1[i]
+            q2 = qual2[i]
+            if c1 == c2:
+                calls.append(c1)
+                quals.append(max(q1, q2))
+            elif q1 != q2 and abs(ord(q2) - ord(q1)) >= minimum_q_delta:
+                # the higher quality base wins if reads disagree by enough
+                calls.append(c1 if q1 > q2 else c2)
+                quals.append(max(q1, q2))
+            else:
+                calls.append('N')  # cannot resolve between discordant bases
+                quals.append(NO_CALL_CHAR)
+        elif c2 == '-':
+            # past end of read 1
+            calls.append('-' if is_reverse_started else 'n')  # 'n' between reads
+            quals.append(KEEP_CALL_CHAR)
+        else:
+            calls.append(c2)
+            quals.append(qual2[i])
+    return ''.join(calls), ''.join(quals)
+
+
+def censor_resolved(calls, quals, q_cutoff):
+    """ Replace base calls from resolve_pairs() with N where the quality is
+    not above q_cutoff, and return the merged sequence """
+    mseq = bytearray(calls)
+    # low quality calls are few, so only runs of them are replaced
+    for match in re.finditer('[\x00-%s]+' % re.escape(chr(q_cutoff+33)), quals):
+        mseq[match.start():match.end()] = 'N' * (match.end() - match.start())
+    return str(mseq)
+
+
+def resolve_pairs_numpy(seq1, seq2, qual1, qual2, minimum_q_delta=5):
+    """
+    Resolve the base call at each aligned column of two reads, independent
+    of the quality cutoff.
+
+    Takes the same arguments as merge_pairs(), without the insertions and
+    q_cutoff.  The merged sequence for any q_cutoff is then given by
+    censor_calls(): each call is kept if its quality is above the cutoff, or
+    reported as an N.  Gaps, the interval between reads ('n') and discordant
+    bases that cannot be resolved ('N') are assigned KEEP_CALL or -1 so that
+    they do not depend on the cutoff.
+    @return: (calls, quals) - uint8 array of base calls and int16 array of
+        Phred+33 quality scores for each position in the merged sequence
+    """
+    # force second read to be longest of the two
+    if len(seq1) > len(seq2):
+        seq1, seq2 = seq2, seq1
+        qual1, qual2 = qual2, qual1
+
+    gap, n_call, n_gap = ord('-'), ord('N'), ord('n')
+    n1 = len(seq1)
+    c1 = np.frombuffer(seq1, dtype=np.uint8)
+    c2 = np.frombuffer(seq2, dtype=np.uint8)
+    q1 = np.frombuffer(qual1, dtype=np.uint8).astype(np.int16)
+    q2 = np.frombuffer(qual2, dtype=np.uint8).astype(np.int16)
+
+    # columns where both reads overlap
+    head1, head2 = c1, c2[:n1]
+    hq1, hq2 = q1, q2[:n1]
+    both_gaps = (head1 == gap) & (head2 == gap)
+    if both_gaps.all():
+        # read 1 never started, so nothing is reported
+        head, head_quals = c1[:0], q1[:0]
+    else:
+        # the higher quality base wins if reads disagree by enough
+        is_resolved = (np.abs(hq2 - hq1) >= minimum_q_delta) & (hq1 != hq2)
+        head = np.where(head1 == head2,
+                        head1,
+                        np.where(is_resolved, np.where(hq1 > hq2, head1, head2), n_call))
+        head_quals = np.where((head1 == head2) | is_resolved, np.maximum(hq1, hq2), -1)
+        head[both_gaps] = gap  # includes the gap prefix before either read
+        head_quals[both_gaps] = KEEP_CALL
+
+    # past end of read 1
+    tail2 = c2[n1:]
+    is_tail_gap = tail2 == gap
+    is_reverse_started = np.logical_or.accumulate(c2 != gap)[n1:]
+    tail = np.where(is_tail_gap, np.where(is_reverse_started, gap, n_gap), tail2)
+    tail_quals = np.where(is_tail_gap, KEEP_CALL, q2[n1:])
+
+    return (np.concatenate((head, tail)).astype(np.uint8),
+            np.concatenate((head_quals, tail_quals)).astype(np.int16))
+
+
+def censor_calls(calls, quals, q_cutoff):
+    """ Replace base calls from resolve_pairs_numpy() with N where the quality
+    is not above q_cutoff, and return the merged sequence as a string """
+    return np.where(quals > q_cutoff+33, calls, ord('N')).astype(np.uint8).tostring()
+
+
+def merge_pairs_numpy(seq1,
+                      seq2,
+                      qual1,
+                      qual2,
+                      ins1=None,
+                      ins2=None,
+                      q_cutoff=10,
+                      minimum_q_delta=5):
+    """
+    Vectorized version of merge_pairs().
+
+    Base calls and quality scores are converted into uint8 arrays, and the
+    rules for agreement, q_cutoff, minimum_q_delta, the interval between
+    reads and the leading gaps are applied with array masks instead of a
+    loop over every aligned column.  Takes the same arguments and returns
+    exactly the same merged sequence as merge_pairs().
+    """
+    calls, quals = resolve_pairs_numpy(seq1, seq2, qual1, qual2, minimum_q_delta)
+    mseq = censor_calls(calls, quals, q_cutoff)
+
+    if ins1 or ins2:
+        merged_inserts = merge_inserts(ins1, ins2, q_cutoff, minimum_q_delta)
+        for pos in sorted(merged_inserts.keys(), reverse=True):
+            ins_mseq = merged_inserts[pos]
+            mseq = mseq[:pos] + ins_mseq + mseq[pos:]
+    return mseq
+
+
+MERGE_ENGINES = {'python': merge_pairs, 'numpy': merge_pairs_numpy}
+# {merge function: (resolve function, censor function)} that split the merge
+# into work shared by every quality cutoff and the censoring for each cutoff
+MERGE_RESOLVERS = {merge_pairs: (resolve_pairs, censor_resolved),
+                   merge_pairs_numpy: (resolve_pairs_numpy, censor_calls)}
+
+
+def merge_pairs_cutoffs(seq1, seq2, qual1, qual2, q_cutoffs, minimum_q_delta=5, merge=merge_pairs):
+    """
+    Combine paired-end reads into a single sequence for each of several
+    quality cutoffs.  With either engine in MERGE_RESOLVERS, discordant bases
+    are resolved once and only the censoring of low quality calls is repeated
+    for each cutoff.  Other merge functions are called once per cutoff.
+    @param q_cutoffs: list of Phred-scaled base quality cutoffs
+    @return: {q_cutoff: merged_sequence}
+    """
+    if merge in MERGE_RESOLVERS:
+        resolve, censor = MERGE_RESOLVERS[merge]
+        calls, quals = resolve(seq1, seq2, qual1, qual2, minimum_q_delta)
+        return dict((q_cutoff, censor(calls, quals, q_cutoff)) for q_cutoff in q_cutoffs)
+    return dict((q_cutoff, merge(seq1, seq2, qual1, qual2,
+                                 q_cutoff=q_cutoff,
+                                 minimum_q_delta=minimum_q_delta))
+                for q_cutoff in q_cutoffs)
+
+
 def merge_inserts(ins1, ins2, q_cutoff=10, minimum_q_delta=5):
     """ Merge two sets of insertions.
 
@@ -212,13 +530,17 @@ def is_first_read(flag):
     return (int(flag) & IS_FIRST_SEGMENT) != 0
 
 
-def parse_read_pair(rows, qcut, max_prop_n):
+def parse_read_pair(rows, qcuts, max_prop_n, merge=merge_pairs):
     """ Merge two matched reads into a single aligned read.
 
     Also report insertions and failed merges.
     @param rows: tuple holding a pair of matched rows - forward and reverse reads
+    @param qcuts: list of quality cutoffs - the CIGAR strings are applied once,
+        and the reads are merged at each cutoff level
+    @param merge: function used to merge the aligned reads, either merge_pairs
+        or merge_pairs_numpy
     @return: (refname, merged_seqs, insert_list, failed_list) where
-        merged_seqs is {qcut: seq} the merged sequence for each cutoff level
+        merged_seqs is {qcut: read} the merged AlignedRead for each cutoff level
         insert_list is [{'qname': query_name,
                          'fwd_rev': 'F' or 'R',
                          'refname': refname,
@@ -254,42 +576,32 @@ def parse_read_pair(rows, qcut, max_prop_n):
         failure_cause = '2refs'
 
     if not failure_cause:
-        pos1 = int(row1['pos'])-1  # convert 1-index to 0-index
-        seq1, qual1, inserts = apply_cigar(cigar1, row1['seq'], row1['qual'])
-
-        # report insertions relative to sample consensus
-        for left, (iseq, iqual) in inserts.iteritems():
-            insert_list.append({'qname': qname,
-                                'fwd_rev': 'F' if is_first_read(row1['flag']) else 'R',
-                                'refname': rname,
-                                'pos': pos1+left,
-                                'insert': iseq,
-                                'qual': iqual})
-
-        seq1 = '-'*pos1 + seq1  # pad sequence on left
-        qual1 = '!'*pos1 + qual1  # assign lowest quality to gap prefix so it does not override mate
-
-        # now process the mate
-        pos2 = int(row2['pos'])-1  # convert 1-index to 0-index
-        seq2, qual2, inserts = apply_cigar(cigar2, row2['seq'], row2['qual'])
-        for left, (iseq, iqual) in inserts.iteritems():
-            insert_list.append({'qname': qname,
-                                'fwd_rev': 'F' if is_first_read(row2['flag']) else 'R',
-                                'refname': rname,
-                                'pos': pos2+left,
-                                'insert': iseq,
-                                'qual': iqual})
-        seq2 = '-'*pos2 + seq2
-        qual2 = '!'*pos2 + qual2
+        reads = []
+        for row in (row1, row2):
+            pos = int(row['pos'])-1  # convert 1-index to 0-index
+            seq, qual, inserts = apply_cigar(row['cigar'], row['seq'], row['qual'])
+
+            # report insertions relative to sample consensus
+            for left, (iseq, iqual) in inserts.iteritems():
+                insert_list.append({'qname': qname,
+                                    'fwd_rev': 'F' if is_first_read(row['flag']) else 'R',
+                                    'refname': rname,
+                                    'pos': pos+left,
+                                    'insert': iseq,
+                                    'qual': iqual})
+            reads.append(AlignedRead(pos, seq, qual, inserts))
 
         # merge reads
-        mseq = merge_pairs(seq1, seq2, qual1, qual2, q_cutoff=qcut)
-        prop_N = mseq.count('N') / float(len(mseq.strip('-')))
-        if prop_N > max_prop_n:
-            # fail read pair
-            failure_cause = 'manyNs'
-        else:
-            mseqs[qcut] = mseq
+        for qcut, mread in merge_reads(reads[0], reads[1], merge, qcuts).iteritems():
+            mseq = mread.seq
+            prop_N = mseq.count('N') / float(len(mseq.strip('-')))
+            if prop_N > max_prop_n:
+                # fail read pair at this cutoff
+                failed_list.append({'qname': qname,
+                                    'qcut': qcut,
+                                    'cause': 'manyNs'})
+            else:
+                mseqs[qcut] = mread
 
     if failure_cause:
         failed_list.append({'qname': qname,
@@ -299,106 +611,564 @@ def parse_read_pair(rows, qcut, max_prop_n):
 
 
 
-def matchmaker(handle, refname):
+SAM_FIELDNAMES = ['qname', 'flag', 'rname', 'pos', 'mapq', 'cigar', 'rnext', 'pnext', 'tlen', 'seq', 'qual']
+# bytes taken by a row cached by pair_rows() besides its line: the qname key,
+# the entry tuple and its slot in the dict, measured on 64-bit Python 2.7
+CACHED_ROW_BYTES = 300
+
+
+def parse_row(line):
+    """ Convert a line of SAM into a dictionary keyed by SAM_FIELDNAMES """
+    return dict(zip(SAM_FIELDNAMES, line.split('\t')[:11]))
+
+
+def spill_rows(cached_rows, tmpdir=None):
+    """
+    Write cached rows to a temporary file, sorted by qname and then by the
+    order in which they were read.
+    :param cached_rows: {qname: (line_number, line)}
+    :return: open temporary file, rewound to the start
+    """
+    run = tempfile.TemporaryFile(dir=tmpdir)
+    for qname, (line_number, line) in sorted(cached_rows.iteritems(), key=itemgetter(0)):
+        run.write('%d\t%s' % (line_number, line if line.endswith('\n') else line+'\n'))
+    run.seek(0)
+    return run
+
+
+def iter_run(run):
+    """ Yield (qname, line_number, line) tuples from a spilled run """
+    for entry in run:
+        line_number, line = entry.split('\t', 1)
+        yield line.split('\t', 1)[0], int(line_number), line
+    run.close()
+
+
+def matchmaker(handle, refnames, max_memory=None, tmpdir=None):
     """
     An iterator that returns pairs of reads sharing a common qname from a SAM file stream.
     Note that unpaired reads will be yielded paired with None.
+    Only reads that mapped to one of refnames are paired.
+    If the header declares that the file is sorted by query name
+    (SO:queryname), mates are paired from adjacent rows without any cache.
     :param handle: open file handle to CSV generated by remap.py
+    :param refnames: collection of reference names
+    :param max_memory: limit on the number of bytes of cached rows, or None
+    :param tmpdir: directory for spilled rows, None for the system default
     :return: yields pairs of rows from DictReader corresponding to paired reads
     """
-    fieldnames = ['qname', 'flag', 'rname', 'pos', 'mapq', 'cigar', 'rnext', 'pnext', 'tlen', 'seq', 'qual']
+    lines = iter(handle)
+    is_qname_sorted = False
+    for line in lines:
+        if not line.startswith('@'):
+            lines = itertools.chain([line], lines)
+            break
+        if line.startswith('@HD') and 'SO:queryname' in line:
+            is_qname_sorted = True
+
+    # skip reads that did not map to a target reference before parsing them
+    records = ((line, parse_row(line)) for line in lines
+               if line.split('\t', 3)[2] in refnames)
+    for rows in pair_rows(records, refnames, is_qname_sorted, max_memory, tmpdir):
+        yield rows
+
+
+def pair_rows(records, refnames, is_qname_sorted=False, max_memory=None, tmpdir=None):
+    """
+    Pair mates among SAM rows that have already been parsed, so that a
+    stream of rows can be shared with other consumers without parsing
+    each line again.
+
+    Rows are cached as lines until their mate appears, and parsed again
+    then, because a parsed row takes several times the memory of its line.
+    When the cached rows use more than max_memory bytes, they are spilled to a sorted temporary file, and
+    mates in different temporary files are joined by an external merge at the
+    end of the stream.
+    :param records: iterable of (line, row) tuples, where row is the result
+                    of parse_row(line), without header lines
+    :param refnames: collection of reference names
+    :param is_qname_sorted: mates are in adjacent rows
+    :param max_memory: limit on the number of bytes of cached rows, or None
+    :param tmpdir: directory for spilled rows, None for the system default
+    :return: yields pairs of rows, with None for a missing mate
+    """
+    previous = None  # (qname, row) of last row in a qname-sorted file
     cached_rows = {}
-    for line in handle:
-        if line.startswith('@'):
-            continue  # skip header row
-        row = dict(zip(fieldnames, line.split('\t')[:11]))
-        qname = row['qname']
-        rname = row['rname']
-        if rname != refname:
+    cached_bytes = 0
+    runs = []
+    for line_number, (line, row) in enumerate(records):
+        if row['rname'] not in refnames:
             continue  # skip read that did not map to target reference
+        qname = row['qname']
+
+        if is_qname_sorted:
+            if previous is None:
+                previous = qname, row
+            elif previous[0] == qname:
+                yield previous[1], row
+                previous = None
+            else:
+                yield previous[1], None
+                previous = qname, row
+            continue
+
         old_row = cached_rows.pop(qname, None)
         if old_row is None:
-            cached_rows[qname] = row
+            cached_rows[qname] = (line_number, line)
+            cached_bytes += len(line) + CACHED_ROW_BYTES
+            if max_memory is not None and cached_bytes > max_memory:
+                runs.append(spill_rows(cached_rows, tmpdir))
+                cached_rows = {}
+                cached_bytes = 0
         else:
             # current row should be the second read of the pair
-            yield old_row, row
+            cached_bytes -= len(old_row[1]) + CACHED_ROW_BYTES
+            yield parse_row(old_row[1]), row
+
+    if previous is not None:
+        yield previous[1], None
+
+    if not runs:
+        # Unmatched reads
+        for _, line in cached_rows.itervalues():
+            yield parse_row(line), None
+        return
+
+    # Join mates that were spilled to different runs
+    cached_run = sorted((qname, line_number, line)
+                        for qname, (line_number, line) in cached_rows.iteritems())
+    merged = heapq.merge(cached_run, *[iter_run(run) for run in runs])
+    for qname, group in itertools.groupby(merged, itemgetter(0)):
+        lines = [line for _, _, line in group]
+        for i in range(0, len(lines), 2):
+            if i+1 < len(lines):
+                yield parse_row(lines[i]), parse_row(lines[i+1])
+            else:
+                yield parse_row(lines[i]), None
 
-    # Unmatched reads
-    for old_row in cached_rows.itervalues():
-        yield old_row, None
+
+def ref_span(row):
+    """ Return the (start, end) reference interval covered by a SAM row, in
+    zero-based coordinates, from its POS and CIGAR without applying the CIGAR.
+    """
+    start = int(row['pos'])-1  # convert 1-index to 0-index
+    return start, start + cigar_cache.get(row['cigar']).ref_span
+
+
+class WindowIndex(object):
+    """ Index of target windows [left:right] on one or more references.
+
+    Windows on each reference are sorted by their left limit, so the windows
+    that overlap an interval are found by bisection between the left limit of
+    the interval minus the longest window length and the right limit of the
+    interval, without scanning every window.
+    """
+    def __init__(self, windows):
+        """
+        :param windows: iterable of (refname, left, right) tuples
+        """
+        self.windows = {}
+        for refname, left, right in set(windows):
+            self.windows.setdefault(refname, []).append((left, right))
+        self.lefts = {}
+        self.max_length = {}
+        for refname, ref_windows in self.windows.iteritems():
+            ref_windows.sort()
+            self.lefts[refname] = [left for left, _ in ref_windows]
+            self.max_length[refname] = max(right-left for left, right in ref_windows)
+
+    def __iter__(self):
+        """ Yield (refname, (left, right)) for every window """
+        for refname, ref_windows in self.windows.iteritems():
+            for window in ref_windows:
+                yield refname, window
+
+    def overlapping(self, refname, start, end):
+        """ Return the list of (left, right) windows on a reference that
+        overlap the interval [start:end].
+        """
+        ref_windows = self.windows.get(refname)
+        if ref_windows is None:
+            return []
+        lefts = self.lefts[refname]
+        first = bisect.bisect_right(lefts, start - self.max_length[refname])
+        last = bisect.bisect_left(lefts, end)
+        return [(left, right) for left, right in ref_windows[first:last] if right > start]
+
+
+def read_windows(handle):
+    """
+    Parse a list of target windows from a BED file (tab-separated reference
+    name, start and end) or a CSV file (refname,left,right), with zero-based
+    coordinates and exclusive right limits like -left and -right.  Comments,
+    track lines and header rows are skipped.
+    :return: list of (refname, left, right) tuples
+    """
+    windows = []
+    for line in handle:
+        if line.startswith(('#', 'track', 'browser')) or not line.strip():
+            continue
+        fields = line.rstrip('\n').split('\t' if '\t' in line else ',')
+        try:
+            windows.append((fields[0], int(fields[1]), int(fields[2])))
+        except (IndexError, ValueError):
+            if windows:
+                raise RuntimeError('Invalid window: {!r}.'.format(line))
+            # otherwise a header row
+    return windows
+
+
+class RegionFilter(object):
+    """ Predicate on matched pairs of rows that drops pairs whose merged read
+    cannot overlap any target window of their reference by at least
+    min_overlap positions, before any CIGAR is applied or any pair is merged.
+
+    The merged read spans from the leftmost start to the rightmost end of the
+    two mates, so the intersection of that span with a window is an upper
+    bound on the overlap computed after merging.  Unmatched pairs and pairs
+    with missing CIGARs are passed on, because parse_read_pair() reports them
+    as failures.  merge_read_pairs() still reports pruned pairs, without a
+    merged read, so that reads keep the numbers they would have without
+    pruning.
+    """
+    def __init__(self, windows, min_overlap):
+        """
+        :param windows: WindowIndex of target regions
+        :param min_overlap: minimum overlap of target region
+        """
+        self.windows = windows
+        self.min_overlap = min_overlap
+        self.kept = 0
+        self.pruned = 0
+
+    def __call__(self, rows):
+        row1, row2 = rows
+        if (row2 is not None and row1['cigar'] != '*' and row2['cigar'] != '*' and
+                row1['rname'] == row2['rname']):
+            start1, end1 = ref_span(row1)
+            start2, end2 = ref_span(row2)
+            start, end = min(start1, start2), max(end1, end2)
+            if not any(min(end, right) - max(start, left) >= self.min_overlap
+                       for left, right in self.windows.overlapping(row1['rname'], start, end)):
+                self.pruned += 1
+                return False
+        self.kept += 1
+        return True
+
+
+def parse_kept_pair(rows, qcuts, max_n, merge=merge_pairs):
+    """ Apply parse_read_pair() to a matched pair of rows, or report a pair
+    that merge_read_pairs() replaced by its reference name because it was
+    pruned, with no read at every cutoff.
+    """
+    if isinstance(rows, basestring):
+        return rows, dict.fromkeys(qcuts), [], []
+    return parse_read_pair(rows, qcuts, max_n, merge)
+
+
+def parse_batch(batch, qcuts, max_n, merge=merge_pairs):
+    """ Apply parse_kept_pair() to a list of matched pairs of rows
+    :return: (list of results, hits and misses of the CIGAR cache of this
+        process while parsing the batch)
+    """
+    hits, misses = cigar_cache.hits, cigar_cache.misses
+    results = [parse_kept_pair(rows, qcuts, max_n, merge) for rows in batch]
+    return results, cigar_cache.hits - hits, cigar_cache.misses - misses
 
 
-def parse_sam(handle, refname, qcut, max_n):
-    iter = itertools.imap(lambda rows: parse_read_pair(rows, qcut, max_n), matchmaker(handle, refname))
+def parallel_parse(pairs, qcuts, max_n, merge, threads, batch_size=1000):
+    """
+    Apply parse_kept_pair() to batches of matched pairs in a pool of worker
+    processes.  Results are yielded in the same order as the input pairs, and
+    at most two batches per process are in flight at any time so that memory
+    use stays flat regardless of the size of the SAM file.  The CIGAR cache
+    hits and misses of the workers are added to those of this process.
+    :param threads: number of worker processes
+    :param batch_size: number of read pairs sent to a worker at a time
+    """
+    pool = multiprocessing.Pool(threads)
+    pending = deque()
+    try:
+        while True:
+            batch = list(itertools.islice(pairs, batch_size))
+            if batch:
+                pending.append(pool.apply_async(parse_batch, (batch, qcuts, max_n, merge)))
+            if pending and (not batch or len(pending) >= 2*threads):
+                results, hits, misses = pending.popleft().get()
+                cigar_cache.hits += hits
+                cigar_cache.misses += misses
+                for result in results:
+                    yield result
+            elif not batch:
+                break
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def parse_sam(handle, refnames, qcuts, max_n, merge=merge_pairs, region=None, threads=1,
+              max_memory=None):
+    """
+    Merge read pairs that mapped to one or more references in a single pass.
+    :param refnames: collection of reference names to keep
+    :param qcuts: list of quality cutoffs
+    :param region: optional RegionFilter to drop read pairs before merging
+    :param threads: number of processes to merge read pairs with
+    :param max_memory: bytes of unpaired rows to cache before spilling to disk
+    :return: yields (refname, {qcut: read}) tuples, with the merged
+        AlignedRead of each pair at every cutoff where it passed, or None at
+        every cutoff for a pair pruned by region
+    """
+    pairs = matchmaker(handle, refnames, max_memory)
+    return merge_read_pairs(pairs, qcuts, max_n, merge, region, threads)
+
+
+def merge_read_pairs(pairs, qcuts, max_n, merge=merge_pairs, region=None, threads=1):
+    """
+    Merge matched pairs of rows from matchmaker() or pair_rows().
+    :return: yields (refname, {qcut: read}) tuples as parse_sam() does
+    """
+    if region is not None:
+        # pass on only the reference name of a pruned pair
+        pairs = itertools.imap(lambda rows: rows if region(rows) else rows[0]['rname'], pairs)
+    if threads > 1:
+        iter = parallel_parse(pairs, qcuts, max_n, merge, threads)
+    else:
+        iter = itertools.imap(lambda rows: parse_kept_pair(rows, qcuts, max_n, merge), pairs)
     for rname, mseqs, insert_list, failed_list in iter:
         if len(mseqs) == 0:
             continue  # failed pair
-        yield mseqs.values()[0]
+        yield rname, mseqs
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Generate a sequence alignment from SAM output of a short read"
-                                                 "mapper, where reads have been filtered to those that map"
-                                                 "to a user-specified interval of the reference.")
+def read_header(handle):
+    """
+    Read the header of a SAM file.
+    :param handle: open file handle to SAM
+    :return: (references, lines) where references is an OrderedDict of
+        reference lengths keyed by name from the @SQ lines, and lines
+        iterates over every line of the file including the header
+    """
+    references = OrderedDict()
+    header = []
+    for line in handle:
+        if not line.startswith('@'):
+            return references, itertools.chain(header, [line], handle)
+        header.append(line)
+        if line.startswith('@SQ'):
+            tags = dict(tag.split(':', 1) for tag in line.rstrip('\n').split('\t')[1:] if ':' in tag)
+            references[tags['SN']] = int(tags['LN'])
+    return references, iter(header)
 
-    # positional arguments
-    parser.add_argument('sam', type=argparse.FileType('rU'),
-                        help='<input> SAM generated by short read mapping')
-    parser.add_argument('out', type=argparse.FileType('w'),
-                        help='<output> FASTA of aligned reads')
 
-    # keyword arguments
-    parser.add_argument('-refname', type=str, default=None,
-                        help='Reference name; must appear in SAM file. '
+def output_path(path, refname=None, window=None, qcut=None):
+    """ Insert the reference name, the window limits and the quality cutoff,
+    where given, before the extension of an output path """
+    labels = []
+    if refname is not None:
+        labels.append(re.sub(r'[^\w.-]', '_', refname))
+    if window is not None:
+        labels.append('%d-%d' % window)
+    if qcut is not None:
+        labels.append('q%d' % qcut)
+    if not labels:
+        return path
+    root, ext = os.path.splitext(path)
+    return '%s.%s%s' % (root, '.'.join(labels), ext or '.fa')
+
+
+def add_slice_arguments(parser):
+    """ Add the options that select windows and control merging and slicing
+    of read pairs to an ArgumentParser """
+    parser.add_argument('-refname', type=str, nargs='+', default=None,
+                        help='Reference name(s); must appear in SAM file. '
                              'Leave blank to output a list of available references.')
+    parser.add_argument('-all', action='store_true',
+                        help='Slice every reference in the SAM header in a single pass.')
     parser.add_argument('-left', type=int, default=0,
                         help='Left limit of alignment to output')
     parser.add_argument('-right', type=int, default=None,
                         help='Right limit of alignment to output. '
-                             'Leave blank to output the reference sequence length (max value).')
-    parser.add_argument('-qcut', type=int, default=15,
-                        help='Quality score cutoff for base censoring')
+                             'Leave blank to output the reference sequence length (max value) '
+                             'of a single reference, or to slice each of several references '
+                             'to its full length.')
+    parser.add_argument('-windows', type=argparse.FileType('rU'), default=None,
+                        help='<input> BED or CSV (refname,left,right) list of windows to slice '
+                             'in a single pass, instead of -refname, -left and -right.  Each '
+                             'window is written to its own output, with the reference name and '
+                             'window limits inserted before the file extension.')
+    parser.add_argument('-qcut', type=int, nargs='+', default=[15],
+                        help='Quality score cutoff(s) for base censoring.  When more than '
+                             'one cutoff is given, each is written to its own output, with '
+                             'q<cutoff> inserted before the file extension.')
     parser.add_argument('-maxN', type=float, default=0.5,
                         help='Reject reads with a greater proportion of ambiguous bases than this cutoff (0 - 1.0)')
     parser.add_argument('-min_overlap', type=int, default=100,
                         help='Minimum overlap of target region (left:right).')
+    parser.add_argument('-engine', choices=sorted(MERGE_ENGINES.keys()),
+                        default='python' if np is None else 'numpy',
+                        help='Merge read pairs with a loop over every aligned column (python) '
+                             'or with vectorized array operations (numpy, requires NumPy).')
+    parser.add_argument('-max_memory', type=int, default=1024,
+                        help='Megabytes of unpaired reads to hold in memory before spilling '
+                             'them to temporary files.')
 
-    args = parser.parse_args()
 
-    if args.refname is None:
-        for line in args.sam:
-            if line.startswith('@SQ'):
-                print re.sub('@SQ[ \t]+SN:(.+)[ \t]+.+', '\\1', line)
-        sys.exit()
+def select_windows(args, references, window_list=None):
+    """
+    Resolve the windows to slice from the options added by
+    add_slice_arguments().  If no reference was selected, or the limits of a
+    single reference are missing, print the references and exit.
+    :param references: OrderedDict of reference lengths from read_header()
+    :param window_list: list of windows read from -windows, if given
+    :return: (WindowIndex, True if outputs are labelled by reference name)
+    """
+    if window_list is not None:
+        windows = WindowIndex(window_list)
+        is_multi = True
+    else:
+        if args.refname is None and not args.all:
+            for refname in references:
+                print refname
+            sys.exit()
 
-    if args.right is None:
-        for line in args.sam:
-            if line.startswith('@SQ') and args.refname in line:
-                print re.sub('@SQ[ \t]+SN:(.+)[ \t]+LN:([0-9]+)[^0-9]*', '\\1  \\2', line)
+        refnames = references.keys() if args.all else args.refname
+        is_multi = len(refnames) > 1 or args.all
+        regions = []
+        for refname in refnames:
+            if args.right is not None:
+                regions.append((refname, args.left, args.right))
+            elif refname not in references:
+                print 'ERROR: Failed to find header line for refname', refname
                 sys.exit()
-        print 'ERROR: Failed to find header line for refname', args.refname
-        sys.exit()
+            elif not is_multi:
+                print '%s  %d' % (refname, references[refname])
+                sys.exit()
+            else:
+                regions.append((refname, args.left, references[refname]))
+        windows = WindowIndex(regions)
 
-    assert args.left >= 0, "Require left >= 0"
-    assert args.right >= 0, "Require right >= 0"
-    assert args.left < args.right, "Require left < right"
+    for _, (left, right) in windows:
+        assert left >= 0, "Require left >= 0"
+        assert right >= 0, "Require right >= 0"
+        assert left < right, "Require left < right"
     assert args.min_overlap > 0, "min_overlap must be greater than zero."
-    assert args.qcut >= 0, "qcut must be a non-negative integer."
+    assert all(qcut >= 0 for qcut in args.qcut), "qcut must be a non-negative integer."
     assert args.maxN >= 0 and args.maxN <= 1.0, "maxN must be between 0 and 1.0 inclusive."
+    assert args.engine == 'python' or np is not None, "numpy engine requires the NumPy module."
+    assert args.max_memory > 0, "max_memory must be greater than zero."
+    return windows, is_multi
+
 
+def open_outputs(path, windows, qcuts, is_multi, label_windows=False):
+    """ Open an output FASTA for every window and quality cutoff
+    :return: {(refname, window, qcut): open file} """
+    outputs = {}
+    for refname, window in windows:
+        for qcut in qcuts:
+            outputs[(refname, window, qcut)] = open(output_path(
+                path,
+                refname if is_multi else None,
+                window if label_windows else None,
+                qcut if len(qcuts) > 1 else None), 'w')
+    return outputs
 
+
+def write_slices(reads, windows, outputs, min_overlap):
+    """
+    Clip merged reads from parse_sam() to each window they overlap, and write
+    them to the outputs from open_outputs().  Reads are numbered in order for
+    each reference and quality cutoff, and a pair pruned by RegionFilter uses
+    up a number at every cutoff, as it would if it had been merged.
+    :return: number of reads written
+    """
     filter_count = 0
-    for mcount, mread in enumerate(parse_sam(args.sam, args.refname, args.qcut, args.maxN)):
-        clip = mread[args.left:args.right]
-        overlap = len(clip) - clip.count('-')
-        if mcount % 1000 == 0:
-            print filter_count, mcount  # progress indicator
+    mcounts = defaultdict(int)
+    for count, (refname, mreads) in enumerate(reads):
+        if count % 1000 == 0:
+            print filter_count, count  # progress indicator
+
+        for qcut, mread in mreads.iteritems():
+            mcount = mcounts[(refname, qcut)]
+            mcounts[(refname, qcut)] += 1
+            if mread is None:
+                continue  # pruned outside every window
+            for left, right in windows.overlapping(refname, mread.ref_offset, mread.ref_end):
+                clip = mread.clip(left, right)
+                overlap = len(clip) - clip.count('-')
+                if overlap < min_overlap:
+                    continue  # not adequate coverage
+
+                filter_count += 1
+                outputs[(refname, (left, right), qcut)].write('>%d\n%s\n' % (mcount, clip))
+
+    for handle in outputs.itervalues():
+        handle.close()
+    return filter_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a sequence alignment from SAM output of a short read"
+                                                 "mapper, where reads have been filtered to those that map"
+                                                 "to a user-specified interval of the reference.")
+
+    # positional arguments
+    parser.add_argument('sam', type=str,
+                        help='<input> SAM or BAM generated by short read mapping')
+    parser.add_argument('out', type=str,
+                        help='<output> FASTA of aligned reads.  When slicing more than one '
+                             'reference, the reference name is inserted before the file '
+                             'extension of each output.')
+
+    # keyword arguments
+    add_slice_arguments(parser)
+    parser.add_argument('-cigar_cache', type=int, default=1024,
+                        help='Maximum number of compiled CIGAR strings to keep in memory.')
+    parser.add_argument('-threads', type=int, default=1,
+                        help='Number of processes used to merge read pairs, and of threads '
+                             'used to decompress BAM input.')
+    parser.add_argument('-max_insert', type=int, default=None,
+                        help='When reading a region of an indexed BAM file, look for read '
+                             'pairs that span the region only this far before it, instead of '
+                             'from the start of the reference.  Pairs longer than this are '
+                             'missed.')
+
+    args = parser.parse_args()
+
+    # Read only the pairs in the target region of an indexed BAM file, if
+    # there is an index
+    fetch = (None, None, None)
+    window_list = None
+    if args.windows is not None:
+        window_list = read_windows(args.windows)
+        if len(set(refname for refname, _, _ in window_list)) == 1:
+            fetch = (window_list[0][0],
+                     min(left for _, left, _ in window_list),
+                     max(right for _, _, right in window_list))
+    elif args.refname is not None and len(args.refname) == 1 and args.right is not None:
+        fetch = (args.refname[0], args.left, args.right)
+
+    references, lines = read_header(open_alignments(args.sam, *fetch, threads=args.threads,
+                                                    max_insert=args.max_insert))
+    windows, is_multi = select_windows(args, references, window_list)
+    assert args.cigar_cache > 0, "cigar_cache must be greater than zero."
+    assert args.threads > 0, "threads must be greater than zero."
+    assert args.max_insert is None or args.max_insert >= 0, \
+        "max_insert must be a non-negative integer."
 
-        if overlap < args.min_overlap:
-            continue  # not adequate coverage
+    qcuts = sorted(set(args.qcut))
+    outputs = open_outputs(args.out, windows, qcuts, is_multi, args.windows is not None)
+    cigar_cache.maxsize = args.cigar_cache
+    region = RegionFilter(windows, args.min_overlap)
+    reads = parse_sam(lines, set(windows.windows), qcuts, args.maxN, MERGE_ENGINES[args.engine],
+                      region, args.threads, args.max_memory * 2**20)
+    write_slices(reads, windows, outputs, args.min_overlap)
 
-        filter_count += 1
-        args.out.write('>%d\n%s\n' % (mcount, clip))
+    print 'Pruned %d of %d read pairs outside region' % (region.pruned, region.pruned + region.kept)
+    print 'CIGAR cache: %d hits, %d misses%s' % (cigar_cache.hits, cigar_cache.misses,
+                                                 ' in %d processes' % (args.threads+1)
+                                                 if args.threads > 1 else '')
 
 if __name__ == '__main__':
     main()
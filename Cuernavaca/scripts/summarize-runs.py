@@ -0,0 +1,153 @@
+"""
+Summarize the phiX error rates of many sequencing runs in one table.
+
+Run folders are found under one or more directories by their
+InterOp/ErrorMetricsOut.bin files, and the read lengths of each run are
+taken from its RunInfo.xml, or are 300 8 8 300 as in parse-interop.py if it
+has none.  Runs are summarized in a pool of processes, and
+the summaries are cached under the modification times and sizes of those
+files, so that only new or changed runs are parsed again on the next call.
+"""
+import os
+import imp
+import csv
+import json
+import argparse
+import tempfile
+import multiprocessing
+
+scripts = os.path.dirname(os.path.abspath(__file__))
+parse_interop = imp.load_source('parse_interop', os.path.join(scripts, 'parse-interop.py'))
+
+ERROR_PATH = os.path.join('InterOp', 'ErrorMetricsOut.bin')
+RUN_FILES = ['RunInfo.xml', ERROR_PATH]
+CACHE_VERSION = 2
+FIELDNAMES = ['run', 'read_lengths', 'records', 'error_rate_fwd', 'error_rate_rev', 'error']
+
+
+def find_runs(roots):
+    """ Yield the path of every run folder under a list of directories.  A run
+    folder is not searched for further run folders. """
+    for root in roots:
+        for dirpath, dirnames, _filenames in os.walk(root):
+            if os.path.exists(os.path.join(dirpath, ERROR_PATH)):
+                dirnames[:] = []
+                yield os.path.abspath(dirpath)
+            else:
+                dirnames.sort()
+
+
+def run_stamp(run):
+    """ Return [name, modification time, size] of each file that a run's
+    summary depends on, or None for a missing file """
+    stamp = []
+    for name in RUN_FILES:
+        try:
+            info = os.stat(os.path.join(run, name))
+        except OSError:
+            stamp.append(None)
+        else:
+            stamp.append([name, info.st_mtime, info.st_size])
+    return stamp
+
+
+def summarize_run(run):
+    """
+    Calculate the mean phiX error rates of the forward and reverse reads of
+    one run.
+    :param run: path of the run folder
+    :return: (run, summary), where summary is a dictionary with the keys of
+             FIELDNAMES other than run.  A run that cannot be parsed has the
+             reason in its error field.
+    """
+    summary = dict(read_lengths=None, records=0)
+    try:
+        run_info = os.path.join(run, 'RunInfo.xml')
+        if os.path.exists(run_info):
+            summary['read_lengths'] = parse_interop.read_run_info(run_info)
+        else:
+            summary['read_lengths'] = parse_interop.DEFAULT_READ_LENGTHS
+        with open(os.path.join(run, ERROR_PATH), 'rb') as data_file:
+            records = parse_interop.read_error_array(data_file)
+        summary['records'] = len(records)
+        parse_interop.phix_cycles(records, summary['read_lengths'], summary)
+    except Exception as e:
+        # one broken run folder must not stop the summary of the others
+        summary['error'] = '%s: %s' % (type(e).__name__, e)
+    return run, summary
+
+
+def load_cache(path):
+    """ Load {run: {'stamp': run_stamp(), 'summary': summary}} from a cache
+    file, or return an empty cache if it is missing or out of date """
+    try:
+        with open(path) as handle:
+            cache = json.load(handle)
+    except (IOError, ValueError):
+        return {}
+    if cache.get('version') != CACHE_VERSION:
+        return {}
+    return cache['runs']
+
+
+def save_cache(path, runs):
+    """ Write the cache to a temporary file and rename it over the old one,
+    so that an interrupted write does not leave a broken cache """
+    handle = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(path)),
+                                         delete=False)
+    with handle:
+        json.dump(dict(version=CACHE_VERSION, runs=runs), handle)
+    os.rename(handle.name, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Summarize phiX error rates of every run folder under one or '
+                    'more directories in a single table.'
+    )
+    parser.add_argument('roots', nargs='+',
+                        help='<input> Directories to search for run folders')
+    parser.add_argument('out', type=argparse.FileType('w'),
+                        help='<output> CSV file with one row per run')
+    parser.add_argument('-threads', type=int, default=1,
+                        help='<option> Number of processes used to parse runs')
+    parser.add_argument('-cache', default=os.path.join(tempfile.gettempdir(),
+                                                       'summarize-runs-cache.json'),
+                        help='<option> File to cache the summaries of runs in')
+    parser.add_argument('-no_cache', action='store_true',
+                        help='<option> Do not read or write the cache')
+    args = parser.parse_args()
+    assert args.threads > 0, "threads must be greater than zero."
+
+    runs = sorted(set(find_runs(args.roots)))
+    cache = {} if args.no_cache else load_cache(args.cache)
+    stamps = dict((run, run_stamp(run)) for run in runs)
+    stale = [run for run in runs if cache.get(run, {}).get('stamp') != stamps[run]]
+
+    if args.threads > 1 and len(stale) > 1:
+        pool = multiprocessing.Pool(args.threads)
+        try:
+            results = pool.map(summarize_run, stale)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results = map(summarize_run, stale)
+    for run, summary in results:
+        cache[run] = dict(stamp=stamps[run], summary=summary)
+    if not args.no_cache:
+        save_cache(args.cache, cache)
+
+    writer = csv.DictWriter(args.out, FIELDNAMES, lineterminator=os.linesep)
+    writer.writeheader()
+    for run in runs:
+        row = dict(cache[run]['summary'], run=run)
+        if row['read_lengths'] is not None:
+            row['read_lengths'] = ';'.join(map(str, row['read_lengths']))
+        writer.writerow(row)
+    print 'Summarized %d of %d runs, %d unchanged' % (len(stale), len(runs), len(runs) - len(stale))
+
+
+if __name__ == '__main__':
+    main()